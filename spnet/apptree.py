@@ -5,6 +5,7 @@ import gplus
 import errors
 from bson import ObjectId
 import json
+from base import ResultsPage, encode_page_token, decode_page_token
 from sessioninfo import get_session
 from urllib import urlencode
 
@@ -61,6 +62,7 @@ class InterestCollection(ArrayDocCollection):
 
 
 class PaperCollection(rest.Collection):
+    readOnlyGET = True # paper pages only display the paper
     def _search(self, searchString, searchType):
         searchString = searchString.strip()
         if not searchString:
@@ -221,11 +223,12 @@ class PersonCollection(rest.Collection):
                 if l: # need to update our object representation to see them
                     person = rest.Collection._GET(self, docID, **kwargs)
         return person
-    def _search(self, searchString):
+    def _search(self, searchString, pageToken=None, pageSize=20):
         if not searchString:
             raise KeyError('empty query')
         searchString = '(?i)' + searchString # default: case-insensitive
-        l = list(self.klass.find_obj({'name': {'$regex': searchString}}))
+        l = self.klass.find_page({'name': {'$regex': searchString}},
+                                 int(pageSize), pageToken)
         if not l:
             raise KeyError('no matches')
         return l
@@ -298,6 +301,10 @@ class PersonSubscriptions(PersonAuthBase):
         return json.dumps(dict(status=status))
 
 class TopicCollection(rest.Collection):
+    def _GET(self, docID, parents={}, recToken=None, postToken=None,
+             **kwargs):
+        'page tokens are just for get_topic.html to page the topic feeds'
+        return rest.Collection._GET(self, docID, parents, **kwargs)
     def _search(self, searchString=None, stem=None):
         if stem:
             return self.stem_search(stem)
@@ -316,15 +323,33 @@ class TopicCollection(rest.Collection):
         return json.dumps(data)
 
 class PostCollection(rest.Collection):
-    def _search(self, searchAll=None):
+    def _search(self, searchAll=None, pageToken=None, pageSize=20):
+        '''search posts and replies, newest first.  pageToken holds
+        a page token for each, to continue where the last page ended'''
         if not searchAll:
             raise KeyError('empty query')
         searchAll = '(?i)' + searchAll # default: case-insensitive
-        l = list(core.Post.find_obj({'posts.text': {'$regex': searchAll}}))
-        l += list(core.Reply.find_obj({'replies.text': {'$regex': searchAll}}))
+        pageSize = int(pageSize)
+        tokens = [None, None]
+        if pageToken:
+            tokens = decode_page_token(pageToken)
+        pages = [core.Post.find_page({'posts.text': {'$regex': searchAll}},
+                                     pageSize, tokens[0]),
+                 core.Reply.find_page({'replies.text': {'$regex': searchAll}},
+                                      pageSize, tokens[1])]
+        l = sorted(pages[0] + pages[1], key=lambda o:o.published,
+                   reverse=True)[:pageSize]
         if not l:
             raise KeyError('no matches')
-        return l
+        more = False
+        for i, page in enumerate(pages): # continue after last one shown
+            shown = [o for o in page if o in l]
+            if shown:
+                klass = page[0].__class__
+                values = shown[-1].get_page_values(klass.get_page_keys())
+                tokens[i] = encode_page_token(values)
+            more = more or len(shown) < len(page) or page.nextToken
+        return ResultsPage(l, more and encode_page_token(tokens) or None)
 
     
 def get_collections(templateDir='_templates'):
@@ -1,7 +1,27 @@
 from bson.objectid import ObjectId
 from bson.errors import InvalidId
+from bson.son import SON
+from bson import BSON
+from pymongo.errors import OperationFailure
+from pymongo.read_preferences import ReadPreference
+from pymongo.collection import Collection
+import pymongo
+try: # pymongo >= 3.2: lazily decoded documents
+    from bson.raw_bson import RawBSONDocument
+    from bson.codec_options import CodecOptions
+except ImportError:
+    RawBSONDocument = None
 from time import mktime, struct_time
 from datetime import datetime
+from collections import OrderedDict, deque
+import threading
+import copy
+import logging
+import random
+import traceback
+import os.path
+import base64
+import time
 import re
 
 
@@ -25,6 +45,8 @@ class LinkDescriptor(object):
         self.missingData = missingData
     def __get__(self, obj, objtype):
         'actually fetch the object(s) specified by cached data'
+        if obj is None: # accessed on the class, e.g. for prefetch()
+            return self
         try: # return the cached attribute
             return obj.__dict__[self.attr]
         except KeyError:
@@ -48,6 +70,25 @@ class LinkDescriptor(object):
             obj.__dict__[self.attr] = data # bypass LinkDescriptor mechanism
             data = data._id # get its ID
         setattr(obj, '_' + self.attr + '_link', data)
+    def get_link(self, obj):
+        'get cached link data for obj, or raise AttributeError'
+        return getattr(obj, '_' + self.attr + '_link')
+    def prefetch(self, objs):
+        'resolve this link for all objs at once, if fetcher can batch it'
+        prefetch = getattr(self.fetcher, 'prefetch', None)
+        if prefetch is None:
+            return # will just be fetched one by one on access
+        if set(self.kwargs) <= set(['profile']):
+            prefetch([o for o in objs if self.attr not in o.__dict__], self)
+
+def prefetch_links(objs, attrs):
+    '''batch-load the LinkDescriptor attrs (e.g. ('author', 'parent'))
+    on every object in list objs, one query per link type'''
+    for klass in set([o.__class__ for o in objs]):
+        l = [o for o in objs if o.__class__ is klass]
+        for attr in attrs:
+            getattr(klass, attr).prefetch(l)
+    return objs
 
 def _get_object_id(fetchID):
     try:
@@ -67,6 +108,178 @@ def convert_to_id(v):
     except AttributeError:
         return v
 
+def update_doc(coll, spec, doc, source=None, **kwargs):
+    '''coll.update() that also drops any cached copy of the target doc.
+    If a WriteSession is active, the update is queued for it instead.
+    source is the Document class making the call, as for timed_call()'''
+    try:
+        forget_doc(coll, spec['_id'])
+    except (KeyError, TypeError):
+        forget_coll(coll) # can't tell which docs change, so drop them all
+    session = get_write_session()
+    if session is not None:
+        if not kwargs and session.add(coll, spec, doc, source):
+            return
+        session.flush(coll) # keep writes to coll in order
+    return timed_call('update', source or coll, coll.update, spec, doc,
+                      **kwargs)
+
+def remove_docs(coll, spec, source=None):
+    '''coll.remove() that also drops any cached copies of the docs.
+    source is the Document class making the call, as for timed_call()'''
+    try:
+        forget_doc(coll, spec['_id'])
+    except (KeyError, TypeError):
+        forget_coll(coll) # can't tell which docs go, so drop them all
+    flush_writes(coll) # keep writes to coll in order
+    return timed_call('remove', source or coll, coll.remove, spec)
+
+def bulk_update(coll, updates, upsert=False, ordered=True, source=None):
+    '''send list of (spec, doc) single-doc updates to coll in one
+    round trip, dropping any cached copies of the target docs.
+    If upsert, insert a doc for each spec that matches none.
+    If not ordered, the server may apply them in any order (faster).
+    source is the Document class making the call, as for timed_call().
+    Returns dict of counts, e.g. nMatched, nUpserted'''
+    if not updates:
+        return dict(nMatched=0, nUpserted=0)
+    for spec, doc in updates:
+        try:
+            forget_doc(coll, spec['_id'])
+        except (KeyError, TypeError):
+            forget_coll(coll) # can't tell which docs change
+            break
+    flush_writes(coll) # keep writes to coll in order
+    try:
+        if ordered:
+            bulk = coll.initialize_ordered_bulk_op()
+        else:
+            bulk = coll.initialize_unordered_bulk_op()
+    except AttributeError: # pymongo < 2.7 has no bulk write API
+        result = dict(nMatched=0, nUpserted=0)
+        for spec, doc in updates:
+            r = timed_call('update', source or coll, coll.update, spec, doc,
+                           upsert=upsert)
+            if r.get('upserted') is not None:
+                result['nUpserted'] += 1
+            else:
+                result['nMatched'] += r.get('n', 0)
+        return result
+    for spec, doc in updates:
+        op = bulk.find(spec)
+        if upsert:
+            op = op.upsert()
+        if is_update_ops(doc):
+            op.update_one(doc)
+        else:
+            op.replace_one(doc)
+    return timed_call('bulk_write', source or coll, bulk.execute)
+
+def get_index_spec(spec):
+    '''convert index spec to (list of (key, direction), options dict).
+    spec is a key name or list of (key, direction) pairs, optionally
+    paired with a dict of ensure_index() options, e.g.
+    ('posts.id', dict(unique=True, sparse=True))'''
+    options = {}
+    if isinstance(spec, tuple) and len(spec) == 2 \
+            and isinstance(spec[1], dict):
+        spec, options = spec
+    if isinstance(spec, basestring):
+        return [(spec, 1)], options
+    return list(spec), options
+
+# keyset pagination: continue after the last result, instead of skip
+
+class ResultsPage(list):
+    'list of query results, with nextToken for the next page, or None'
+    def __init__(self, results=(), nextToken=None):
+        list.__init__(self, results)
+        self.nextToken = nextToken
+
+def encode_page_token(values):
+    'opaque URL-safe token for a list of values (BSON types allowed)'
+    return base64.urlsafe_b64encode(BSON.encode(dict(v=values)))
+
+def decode_page_token(token):
+    'get list of values from encode_page_token(), or raise KeyError'
+    try:
+        return BSON(base64.urlsafe_b64decode(str(token))).decode()['v']
+    except Exception:
+        raise KeyError('invalid page token')
+
+def get_keyset_query(keys, values):
+    '''query for results after values in the order given by keys,
+    a list of (key, direction) pairs whose last key is unique'''
+    l = []
+    for i, (k, direction) in enumerate(keys):
+        q = dict([(k2, v) for (k2, d2), v in zip(keys[:i], values)])
+        q[k] = {direction < 0 and '$lt' or '$gt': values[i]}
+        l.append(q)
+    return {'$or': l}
+
+def get_sort_list(sortKeys):
+    'convert dict (one key), SON or list of (key, direction) to sort list'
+    if isinstance(sortKeys, dict) and not isinstance(sortKeys, SON) \
+            and len(sortKeys) > 1: # plain dict has no defined key order
+        raise ValueError('use list of (key, direction) to sort on %s'
+                         % ', '.join(sortKeys))
+    elif isinstance(sortKeys, dict):
+        return sortKeys.items()
+    return list(sortKeys)
+
+def aggregate_iter(coll, pipeline, **kwargs):
+    'run aggregation pipeline, returning an iterator over its results'
+    flush_writes(coll)
+    r = timed_call('aggregate', coll, coll.aggregate, pipeline, cursor={},
+                   **kwargs) # streams from server
+    try:
+        r = iter(r['result']) # older pymongo returns all results at once
+    except TypeError:
+        pass
+    return counted_iter('aggregate', coll, r, pipeline, calls=0)
+
+_readColls = {} # {(collection key, option): (coll, derived coll)}
+
+def get_read_coll(coll, readPreference):
+    '''get copy of collection coll that reads using readPreference,
+    e.g. 'secondaryPreferred' to send queries to a secondary'''
+    key = (coll.full_name, readPreference)
+    try:
+        c, readColl = _readColls[key]
+        if c is coll: # not replaced by a new connection
+            return readColl
+    except KeyError:
+        pass
+    mode = getattr(ReadPreference,
+                   re.sub('([A-Z])', r'_\1', readPreference).upper())
+    if pymongo.version_tuple[0] >= 3:
+        readColl = coll.with_options(read_preference=mode)
+    else:
+        readColl = Collection(coll.database, coll.name, read_preference=mode)
+    _readColls[key] = (coll, readColl)
+    return readColl
+
+def get_raw_coll(coll):
+    '''get copy of collection coll that returns RawBSONDocuments, which
+    decode fields only when accessed (or coll, if pymongo lacks them)'''
+    if RawBSONDocument is None:
+        return coll
+    key = (id(coll), 'rawBSON')
+    try:
+        c, rawColl = _readColls[key]
+        if c is coll:
+            return rawColl
+    except KeyError:
+        pass
+    rawColl = coll.with_options(codec_options=
+                                CodecOptions(document_class=RawBSONDocument))
+    _readColls[key] = (coll, rawColl)
+    return rawColl
+
+class ReadOnlyError(ValueError):
+    'attempt to save changes to a Document loaded with readOnly'
+    pass
+
 def convert_times(d):
     'convert times to format that pymongo can serialize'
     for k,v in d.items():
@@ -74,13 +287,460 @@ def convert_times(d):
             d[k] = datetime.fromtimestamp(mktime(v))
             
 
+# per-request counts of db calls, docs and bytes returned, and time
+
+class DBStats(object):
+    '''counts db calls, docs and bytes returned, and time taken, by
+    operation, for db calls made in this thread.  Usage:
+    with DBStats('GET /papers') as stats:
+        ... handle request ...
+    print stats.summary()
+    Bytes are counted only for raw BSON results, unless countBytes
+    (which re-encodes every other doc returned, so is not free).
+    A nested DBStats simply re-uses the outermost one.'''
+    def __init__(self, route=None, countBytes=False):
+        self.route = route
+        self.countBytes = countBytes
+        self.ops = {} # {op: [calls, docs, bytes, seconds]}
+        self._active = False
+    def __enter__(self):
+        if getattr(_threadState, 'dbStats', None) is None:
+            _threadState.dbStats = self
+            self._active = True
+        return _threadState.dbStats
+    def __exit__(self, *args):
+        if self._active:
+            _threadState.dbStats = None
+            self._active = False
+    def add(self, op, calls=0, docs=0, nbytes=0, seconds=0.):
+        counts = self.ops.setdefault(op, [0, 0, 0, 0.])
+        counts[0] += calls
+        counts[1] += docs
+        counts[2] += nbytes
+        counts[3] += seconds
+    def doc_size(self, d):
+        'size in bytes of doc d returned by the db, if cheap to get'
+        try:
+            return len(d.raw) # raw BSON, e.g. readOnly results
+        except AttributeError:
+            pass
+        if self.countBytes:
+            return len(BSON.encode(d))
+        return 0
+    def totals(self):
+        'get [calls, docs, bytes, seconds] summed over all operations'
+        return [sum(t) for t in zip([0, 0, 0, 0.], *self.ops.values())]
+    def summary(self):
+        'one-line summary, e.g. for a log line or response header'
+        calls, docs, nbytes, seconds = self.totals()
+        s = 'calls=%d docs=%d bytes=%d ms=%.1f' % (calls, docs, nbytes,
+                                                   seconds * 1000.)
+        for op, counts in sorted(self.ops.items()):
+            s += ' %s=%d' % (op, counts[0])
+        return s
+
+def get_db_stats():
+    'return DBStats active in this thread, or None'
+    return getattr(_threadState, 'dbStats', None)
+
+def timed_call(op, source, func, *args, **kwargs):
+    """call db method func, recording it as op in the active DBStats,
+    and in the slow query log if it is slow.  source is the Document
+    class making the call, or the collection if that is unknown"""
+    stats = get_db_stats()
+    slowLog = slowQueryLog
+    if slowLog is not None and not slowLog.sample():
+        slowLog = None
+    if stats is None and slowLog is None:
+        return func(*args, **kwargs)
+    t = time.time()
+    try:
+        r = func(*args, **kwargs)
+    finally:
+        seconds = time.time() - t
+        if stats is not None:
+            stats.add(op, 1, seconds=seconds)
+        if slowLog is not None:
+            slowLog.record(op, source, args and args[0] or None, seconds)
+    if stats is not None and op in ('find_one', 'find_and_modify') and r:
+        stats.add(op, docs=1, nbytes=stats.doc_size(r))
+    return r
+
+def counted_iter(op, source, it, query=None, calls=1):
+    """wrap iterator over db results, recording them in the active
+    DBStats, and in the slow query log if retrieving them is slow"""
+    stats = get_db_stats()
+    slowLog = slowQueryLog
+    if slowLog is not None and not slowLog.sample():
+        slowLog = None
+    if stats is None and slowLog is None:
+        return it
+    return _counted_iter(stats, slowLog, op, source, iter(it), query, calls)
+
+def _counted_iter(stats, slowLog, op, source, it, query, calls):
+    if stats is not None:
+        stats.add(op, calls)
+    seconds = 0. # total time spent waiting on the db
+    try:
+        while True:
+            t = time.time()
+            try:
+                d = it.next()
+            except StopIteration:
+                break
+            finally:
+                seconds += time.time() - t
+            if stats is not None:
+                stats.add(op, docs=1, nbytes=stats.doc_size(d))
+            yield d
+    finally:
+        if stats is not None:
+            stats.add(op, seconds=seconds)
+        if slowLog is not None:
+            slowLog.record(op, source, query, seconds)
+
+
+# slow query log: sampled record of db calls slower than a threshold
+
+slowQueryLogger = logging.getLogger('spnet.slowquery')
+_callSiteModules = ('core.py', 'apptree.py', 'view.py', 'rest.py',
+                    'webui.py', 'incoming.py', 'bulk.py', 'gplus.py')
+
+def query_shape(query):
+    'copy of query with its values stripped, e.g. {"posts.id": "?"}'
+    if isinstance(query, dict):
+        return dict([(k, query_shape(v)) for k,v in query.items()])
+    elif isinstance(query, (list, tuple)) and query \
+            and all([isinstance(v, dict) for v in query]): # pipeline, $or
+        return [query_shape(v) for v in query]
+    return '?'
+
+def get_call_site(depth=4):
+    """compact stack of the innermost spnet module and template frames,
+    e.g. 'core.py:123 get_replies < index.html:45'"""
+    l = []
+    for filename, line, func, text in reversed(traceback.extract_stack()):
+        name = os.path.basename(filename)
+        if name.endswith('.html'):
+            l.append('%s:%d' % (name, line))
+        elif name in _callSiteModules:
+            l.append('%s:%d %s' % (name, line, func))
+        if len(l) >= depth:
+            break
+    return ' < '.join(l)
+
+class SlowQueryLog(object):
+    """keeps the most recent db calls that took longer than threshold
+    seconds, with Document class, query shape, duration and call site.
+    Only a sampleRate fraction of calls is timed, to keep it cheap."""
+    def __init__(self, threshold=0.1, sampleRate=1., maxlen=1000,
+                 stackDepth=4):
+        self.threshold = threshold
+        self.sampleRate = sampleRate
+        self.stackDepth = stackDepth
+        self.entries = deque(maxlen=maxlen)
+    def sample(self):
+        'True if this call should be timed'
+        return self.sampleRate >= 1. or random.random() < self.sampleRate
+    def record(self, op, source, query, seconds):
+        'save and log this call if it was slow'
+        if seconds < self.threshold:
+            return
+        if isinstance(source, type): # Document class
+            name = source.__name__
+        else: # collection
+            name = source.full_name
+        entry = dict(op=op, klass=name, shape=query_shape(query),
+                     ms=seconds * 1000., stack=get_call_site(self.stackDepth),
+                     time=datetime.utcnow())
+        self.entries.append(entry)
+        slowQueryLogger.warning('slow %(op)s %(klass)s %(shape)s '
+                                '%(ms).1f ms at %(stack)s', entry)
+
+slowQueryLog = None # off unless enabled
+
+def set_slow_query_log(threshold=0.1, sampleRate=1., maxlen=1000):
+    """log db calls slower than threshold seconds, checking only a
+    sampleRate fraction of calls; threshold=None disables it"""
+    global slowQueryLog
+    if threshold is not None:
+        slowQueryLog = SlowQueryLog(threshold, sampleRate, maxlen)
+    else:
+        slowQueryLog = None
+
+
+# unit of work: merge each document's writes, and send them together
+
+def is_update_ops(doc):
+    'True if doc consists of update operators, e.g. $set'
+    return all(k.startswith('$') for k in doc)
+
+def _paths_overlap(a, b):
+    return a == b or a.startswith(b + '.') or b.startswith(a + '.')
+
+def _each_list(v):
+    'list of values pushed by $push / $addToSet value v, or None'
+    if not isinstance(v, dict) or not any(k.startswith('$') for k in v):
+        return [v]
+    elif v.keys() == ['$each']:
+        return list(v['$each'])
+    return None # other modifiers e.g. $slice, can't merge
+
+def _merge_each(old, new):
+    l, l2 = _each_list(old), _each_list(new)
+    if l is None or l2 is None:
+        return None
+    return {'$each': l + l2}
+
+_mergeOps = {'$set': lambda old, new: new,
+             '$unset': lambda old, new: new,
+             '$inc': lambda old, new: old + new,
+             '$push': _merge_each,
+             '$addToSet': _merge_each}
+
+def merge_update(target, doc):
+    '''merge update operators of doc into target, if mongodb can
+    apply them as a single update; otherwise return False'''
+    if not is_update_ops(target) or not is_update_ops(doc):
+        return False
+    merged = []
+    for op, fields in doc.items():
+        for path, v in fields.items():
+            for op2, fields2 in target.items():
+                for path2 in fields2:
+                    if not _paths_overlap(path, path2):
+                        continue
+                    elif op2 != op or path2 != path or op not in _mergeOps:
+                        return False # mongodb rejects conflicting ops
+                    v = _mergeOps[op](fields2[path2], v)
+                    if v is None:
+                        return False
+            merged.append((op, path, v))
+    for op, path, v in merged:
+        target.setdefault(op, {})[path] = v
+    return True
+
+class WriteSession(object):
+    '''unit of work: collects update_doc() writes made in this thread,
+    merges writes to the same document, and sends them as one bulk
+    write per collection on exit.  Usage:
+    with WriteSession():
+        ... save posts ...
+    Querying a collection first sends its pending writes, so reads
+    still see them.  A nested WriteSession re-uses the outermost one.'''
+    def __init__(self):
+        self.pending = [] # [coll, spec, doc, source] in the order received
+        self.last = {} # {(collection name, _id): latest pending entry}
+        self._active = False
+    def __enter__(self):
+        if getattr(_threadState, 'writeSession', None) is None:
+            _threadState.writeSession = self
+            self._active = True
+        return _threadState.writeSession
+    def __exit__(self, *args):
+        if self._active:
+            _threadState.writeSession = None
+            self._active = False
+            self.flush()
+    def add(self, coll, spec, doc, source=None):
+        'queue update of one doc, merging with its last one if possible'
+        try:
+            key = (coll.full_name, spec['_id'])
+            entry = self.last.get(key)
+        except (KeyError, TypeError):
+            return False # not a single-doc update
+        if entry is None or entry[1] != spec \
+                or not merge_update(entry[2], doc):
+            if is_update_ops(doc): # copy, since later writes merge into it
+                doc = dict([(op, dict(fields)) for op, fields in doc.items()])
+            entry = [coll, spec, doc, source]
+            self.pending.append(entry)
+            self.last[key] = entry
+        return True
+    def flush(self, coll=None):
+        'send pending writes (only those for coll, if specified) to the DB'
+        if coll is None:
+            todo, self.pending = self.pending, []
+            self.last.clear()
+        else:
+            name = coll.full_name
+            todo = [e for e in self.pending if e[0].full_name == name]
+            if not todo:
+                return
+            self.pending = [e for e in self.pending if e[0].full_name != name]
+            for key in [k for k in self.last if k[0] == name]:
+                del self.last[key]
+        byColl = OrderedDict()
+        for c, spec, doc, source in todo:
+            group = byColl.setdefault(c.full_name, [c, [], source])
+            group[1].append((spec, doc))
+            if group[2] is not source: # mixed callers: log the collection
+                group[2] = None
+        for c, updates, source in byColl.values():
+            bulk_update(c, updates, source=source)
+
+def get_write_session():
+    'return WriteSession active in this thread, or None'
+    return getattr(_threadState, 'writeSession', None)
+
+def flush_writes(coll):
+    'send writes to coll pending in this thread, so a query will see them'
+    session = get_write_session()
+    if session is not None and session.pending:
+        session.flush(coll)
+
+
+# identity map: each _id is loaded at most once per request
+
+_threadState = threading.local()
+
+class DocCache(object):
+    'bounded LRU cache of doc dicts, shared by all threads in this process'
+    def __init__(self, maxsize=1000, maxAge=60.):
+        self.maxsize = maxsize
+        self.maxAge = maxAge # seconds before a cached doc is considered stale
+        self._docs = OrderedDict()
+        self._lock = threading.Lock()
+    def get(self, key):
+        'return private (deep) copy of cached doc dict, or raise KeyError'
+        with self._lock:
+            d, t = self._docs.pop(key)
+            if time.time() - t > self.maxAge:
+                raise KeyError('stale cache entry')
+            self._docs[key] = (d, t) # now most recently used
+        return copy.deepcopy(d) # so changes to arrays etc. can't leak
+    def put(self, key, d):
+        with self._lock:
+            self._docs.pop(key, None)
+            self._docs[key] = (copy.deepcopy(d), time.time())
+            while len(self._docs) > self.maxsize: # drop least recently used
+                self._docs.popitem(last=False)
+    def discard(self, key):
+        with self._lock:
+            self._docs.pop(key, None)
+    def discard_coll(self, collName):
+        with self._lock:
+            for key in [k for k in self._docs if k[0] == collName]:
+                del self._docs[key]
+
+sharedDocCache = None # process-wide layer is off unless enabled
+
+def set_shared_cache(maxsize=1000, maxAge=60.):
+    'enable process-wide LRU doc cache; maxsize=0 disables it'
+    global sharedDocCache
+    if maxsize:
+        sharedDocCache = DocCache(maxsize, maxAge)
+    else:
+        sharedDocCache = None
+
+class IdentityMap(object):
+    '''request-scoped cache of Document objects keyed by
+    (collection name, _id).  Usage:
+    with IdentityMap():
+        ... render page ...
+    A nested IdentityMap simply re-uses the outermost one.'''
+    def __init__(self):
+        self.objects = {}
+        self.partials = {} # {key:{profile:obj}} for partially loaded docs
+        self._active = False
+    def __enter__(self):
+        if getattr(_threadState, 'identityMap', None) is None:
+            _threadState.identityMap = self
+            self._active = True
+        return _threadState.identityMap
+    def __exit__(self, *args):
+        if self._active:
+            _threadState.identityMap = None
+            self._active = False
+
+def get_identity_map():
+    'return IdentityMap active in this thread, or None'
+    return getattr(_threadState, 'identityMap', None)
+
+def get_cached_obj(klass, fetchID, profile=None):
+    '''return klass object already loaded in this request, or raise KeyError.
+    A full object is returned in preference to one loaded with profile'''
+    m = get_identity_map()
+    if m is None:
+        raise KeyError('no active IdentityMap')
+    key = klass._cache_key(fetchID)
+    try:
+        o = m.objects[key]
+    except KeyError:
+        if not profile:
+            raise
+        o = m.partials[key][profile]
+    if o.__class__ is not klass:
+        raise KeyError('cached object has different class')
+    return o
+
+def get_cached_doc(key):
+    '''return private copy of doc dict for key from request or process
+    cache, or raise KeyError'''
+    m = get_identity_map()
+    if m is not None:
+        try:
+            return copy.deepcopy(m.objects[key]._dbDocDict)
+        except KeyError:
+            pass
+    if sharedDocCache is None:
+        raise KeyError('no shared cache')
+    return sharedDocCache.get(key)
+
+def remember_obj(o, profile=None):
+    '''save object loaded from DB in the identity map and shared cache.
+    Objects loaded with a projection profile are only kept in the former'''
+    key = (o.coll.full_name, o._id)
+    m = get_identity_map()
+    if profile:
+        if m is not None:
+            m.partials.setdefault(key, {})[profile] = o
+        return
+    if m is not None:
+        m.objects[key] = o
+        m.partials.pop(key, None) # full object supersedes partial ones
+    if sharedDocCache is not None:
+        sharedDocCache.put(key, o._dbDocDict)
+
+def forget_doc(coll, docID):
+    'drop cached copies of a doc that is about to change in the DB'
+    key = (coll.full_name, docID)
+    m = get_identity_map()
+    if m is not None:
+        m.objects.pop(key, None)
+        m.partials.pop(key, None)
+    if sharedDocCache is not None:
+        sharedDocCache.discard(key)
+
+def forget_coll(coll):
+    'drop cached copies of all docs from this collection'
+    m = get_identity_map()
+    if m is not None:
+        for d in (m.objects, m.partials):
+            for key in [k for k in d if k[0] == coll.full_name]:
+                del d[key]
+    if sharedDocCache is not None:
+        sharedDocCache.discard_coll(coll.full_name)
+
+
 # base document classes
 
 # two different mechanisms for subobject references:
 #
 # LinkDescriptor: for foreign key; defers construction until getattr()
-# _attrHandler: for subdocuments; constructs them immediately on loading
-#               the parent document.
+# _attrHandler: for subdocuments; SaveAttr constructs them immediately on
+#               loading the parent document, SaveAttrList on first getattr().
+
+def projection_excludes(fields, attr):
+    '''True if mongodb projection fields could have left out attr,
+    i.e. excludes it (attr: 0), or is an inclusion that omits it'''
+    if not isinstance(fields, dict): # list of field names to include
+        fields = dict.fromkeys(fields, 1)
+    matches = [v for k, v in fields.items()
+               if k == attr or k.startswith(attr + '.')]
+    if [v for k, v in fields.items() if k != '_id' and v]: # inclusion
+        return not matches
+    return bool(matches) # excluded, or a subfield of it was
 
 def base_find_or_insert(klass, fetchID, **kwargs):
     'save to db if not already present'
@@ -92,13 +752,28 @@ def base_find_or_insert(klass, fetchID, **kwargs):
 class Document(object):
     'base class provides flexible method for storing dict as attr objects'
     useObjectId = True
-    
-    def __init__(self, fetchID=None, docData=None, insertNew=True):
+    useIdentityMap = True # share objects loaded by _id within a request
+    _fields = None # projection used to load this doc, if only partial
+    _profiles = {} # named projections, e.g. dict(card=dict(name=1))
+    _indexes = () # index specs for our queries, see get_index_spec()
+    readPreference = None # e.g. 'secondaryPreferred' for find() queries
+    _readOnly = False # loaded as raw BSON for display only, refuse writes
+
+    def __init__(self, fetchID=None, docData=None, insertNew=True,
+                 fields=None, readOnly=False):
         '''data can be passed in either as object IDs or as objects
 
         If fetchID provided, retrieves that doc, or raises KeyError.
+        fields, if provided, is a mongodb projection restricting what
+        is retrieved, e.g. Paper.noArrays.  readOnly retrieves it as
+        raw BSON, decoding only the fields that are used, and refuses
+        any attempt to save changes.
         Otherwise, the object is initialized from docData,
         and if insertNew, ALSO inserted into the database.'''
+        if fields:
+            self._fields = fields
+        if readOnly:
+            self._readOnly = True
         if fetchID:
             docData = self._get_doc(fetchID)
         elif insertNew:
@@ -106,17 +781,127 @@ class Document(object):
             self.insert(docData) # save to database
         self._dbDocDict = docData
         self.set_attrs(docData) # expose as object attributes
+        if fetchID and self.useIdentityMap and self._fields is None \
+                and not self._readOnly:
+            remember_obj(self)
+
+    def __getattr__(self, attr):
+        '''build lazily-hydrated subdocument lists on first access;
+        transparently reload a partially loaded doc in full if needed'''
+        try:
+            saveFunc, data = self.__dict__['_lazyAttrs'].pop(attr)
+        except KeyError:
+            pass
+        else:
+            return saveFunc.build(self, attr, data)
+        fields = self.__dict__.get('_fields')
+        if fields is None or attr.startswith('__') \
+                or not projection_excludes(fields, attr):
+            raise AttributeError(attr) # simply not present in this doc
+        self._load_full()
+        return getattr(self, attr)
+
+    def _load_full(self):
+        'reload partially loaded doc with all its fields'
+        self._fields = None
+        d = self._get_doc(self._id)
+        self._dbDocDict = d
+        self.set_attrs(d)
+        if self.useIdentityMap and not self._readOnly:
+            remember_obj(self)
+
+    @classmethod
+    def _normalize_id(klass, fetchID):
+        'convert fetchID to the form stored as _id, or raise KeyError'
+        if getattr(klass, 'useObjectId', False):
+            return _get_object_id(fetchID)
+        return fetchID
+
+    @classmethod
+    def _cache_key(klass, fetchID):
+        'identity map key for the doc with this ID'
+        return klass.coll.full_name, klass._normalize_id(fetchID)
+
+    @classmethod
+    def fetch(klass, fetchID, profile=None, **kwargs):
+        '''same as klass(fetchID), but re-uses object already loaded in
+        request.  profile names a projection from klass._profiles to load
+        only some fields; other attrs are loaded when first accessed.'''
+        if profile:
+            kwargs['fields'] = klass._profiles[profile]
+        if not klass.useIdentityMap or not set(kwargs) <= set(['fields']):
+            return klass(fetchID, **kwargs)
+        try:
+            return get_cached_obj(klass, fetchID, profile)
+        except KeyError:
+            pass
+        o = klass(fetchID, **kwargs)
+        if o._fields is not None:
+            remember_obj(o, profile)
+        return o
 
-    def check_required_fields(self, docData):
-        for attr in getattr(self, '_requiredFields', ()):
+    @classmethod
+    def get_read_coll(klass, readPreference=None):
+        '''get collection for queries, reading with readPreference,
+        or else our class readPreference, if any'''
+        readPreference = readPreference or klass.readPreference
+        if not readPreference:
+            return klass.coll
+        return get_read_coll(klass.coll, readPreference)
+
+    @classmethod
+    def ensure_indexes(klass):
+        'create the indexes listed in _indexes, if not already present'
+        for spec in klass._indexes:
+            keys, options = get_index_spec(spec)
+            klass.coll.ensure_index(keys, **options)
+
+    @classmethod
+    def fetch_many(klass, fetchIDs, profile=None):
+        '''get dict of {_id:obj} for all fetchIDs found in the DB,
+        using a single $in query for those not already loaded.
+        profile restricts the fields loaded, as for fetch()'''
+        found = {}
+        ids = []
+        for fetchID in fetchIDs:
+            try:
+                fetchID = klass._normalize_id(fetchID)
+            except KeyError:
+                continue # invalid ID cannot match any doc
+            try:
+                found[fetchID] = get_cached_obj(klass, fetchID, profile)
+            except KeyError:
+                ids.append(fetchID)
+        if ids:
+            fields = profile and klass._profiles[profile] or None
+            for o in klass.find_obj({'_id': {'$in': ids}}, fields=fields):
+                if fields:
+                    remember_obj(o, profile)
+                found[o._id] = o
+        return found
+
+    @classmethod
+    def check_required_fields(klass, docData):
+        for attr in getattr(klass, '_requiredFields', ()):
             if attr not in docData:
                 raise ValueError('missing required field %s' % attr)
 
     def _get_doc(self, fetchID):
-        'get doc dict from DB'
+        'get doc dict from identity map / shared cache, or else from DB'
         if getattr(self, 'useObjectId', False):
             fetchID = _get_object_id(fetchID)
-        d = self.coll.find_one(fetchID)
+        try:
+            d = get_cached_doc((self.coll.full_name, fetchID))
+            self._fields = None # full doc is already loaded, so use it
+            return d
+        except KeyError:
+            pass
+        flush_writes(self.coll)
+        coll = self.coll
+        if self._readOnly: # decode fields lazily
+            coll = get_raw_coll(coll)
+        d = timed_call('find_one', self.__class__, coll.find_one,
+                       fetchID, self._fields)
         if not d:
             raise KeyError('%s %s not found'
                            % (self.__class__.__name__, fetchID))
@@ -140,29 +925,68 @@ class Document(object):
             d['_id'] = d[self._idField]
         except AttributeError:
             pass
-        self._id = self.coll.insert(convert_obj_to_id(d))
+        self._id = timed_call('insert', self.__class__, self.coll.insert,
+                              convert_obj_to_id(d))
         self._dbDocDict = d
         self._isNewInsert = True
 
+    @classmethod
+    def insert_many(klass, docs, returnObjects=False):
+        '''insert list of doc dicts into the DB in one round trip,
+        setting _id on each.  If returnObjects, return list of objects
+        constructed from them; otherwise return list of their IDs'''
+        if not docs:
+            return []
+        l = []
+        for d in docs:
+            klass.check_required_fields(d)
+            try: # if class defines _idField, store it as mongodb _id
+                d['_id'] = d[klass._idField]
+            except AttributeError:
+                pass
+            l.append(convert_obj_to_id(d))
+        ids = timed_call('insert', klass, klass.coll.insert, l)
+        for d, docID in zip(docs, ids):
+            d['_id'] = docID
+        if not returnObjects:
+            return ids
+        return [klass(docData=d, insertNew=False) for d in docs]
+
+    def check_writable(self):
+        'raise ReadOnlyError if this object was loaded with readOnly'
+        if self._readOnly or (RawBSONDocument is not None and isinstance(
+                self.__dict__.get('_dbDocDict'), RawBSONDocument)):
+            raise ReadOnlyError('%s was loaded read-only'
+                                % self.__class__.__name__)
+
     def update(self, updateDict, op='$set'):
         'update the specified fields in the DB'
-        self.coll.update({'_id': self._id}, {op: updateDict})
+        self.check_writable()
+        update_doc(self.coll, {'_id': self._id}, {op: updateDict},
+                   source=self.__class__)
         self._dbDocDict.update(updateDict)
         self.set_attrs(updateDict)
         
     def delete(self):
         'delete this record from the DB'
-        self.coll.remove(self._id)
+        self.check_writable()
+        forget_doc(self.coll, self._id)
+        flush_writes(self.coll)
+        timed_call('remove', self.__class__, self.coll.remove, self._id)
 
     def array_append(self, attr, v):
         'append v to array stored as attr'
+        self.check_writable()
         v = convert_to_id(v)
-        self.coll.update({'_id': self._id}, {'$push': {attr: v}})
+        update_doc(self.coll, {'_id': self._id}, {'$push': {attr: v}},
+                   source=self.__class__)
 
     def array_del(self, attr, v):
         'remove element v from array stored as attr'
+        self.check_writable()
         v = convert_to_id(v)
-        self.coll.update({'_id': self._id}, {'$pull': {attr: v}})
+        update_doc(self.coll, {'_id': self._id}, {'$pull': {attr: v}},
+                   source=self.__class__)
 
     def __cmp__(self, other):
         try:
@@ -188,22 +1012,47 @@ class Document(object):
 
     @classmethod
     def find(klass, queryDict={}, fields=None, idOnly=True,
-             sortKeys=None, limit=None, **kwargs):
-        'generic class method for searching a specific collection'
+             sortKeys=None, limit=None, skip=None, pipeline=None,
+             readPreference=None, readOnly=False, **kwargs):
+        '''generic class method for searching a specific collection.
+        sortKeys (dict with one key, or list of (key, direction) pairs),
+        skip and limit are applied on the server to a streaming cursor.
+        To use the aggregation framework instead, pass pipeline, a list
+        of stages to run after matching queryDict (and before any
+        sort / skip / limit / fields projection).
+        readPreference overrides the class readPreference for this query.
+        readOnly returns raw BSON documents that decode fields lazily.'''
+        coll = klass.get_read_coll(readPreference)
+        if readOnly:
+            coll = get_raw_coll(coll)
         if fields:
             idOnly = False
         if idOnly:
             fields = {'_id':1}
-        if sortKeys or limit: # use new mongodb aggregation framework
-            pipeline = []
+        if pipeline is not None: # explicit aggregation mode
+            stages = []
+            if queryDict:
+                stages.append({'$match': queryDict})
+            stages += pipeline
             if sortKeys:
-                pipeline.append({'$sort':sortKeys})
+                stages.append({'$sort': SON(get_sort_list(sortKeys))})
+            if skip:
+                stages.append({'$skip': skip})
             if limit:
-                pipeline.append({'$limit':limit})
-            r = klass.coll.aggregate(pipeline)
-            it = iter(r['result'])
+                stages.append({'$limit': limit})
+            if fields:
+                stages.append({'$project': fields})
+            it = aggregate_iter(coll, stages, **kwargs)
         else:
-            it = klass.coll.find(queryDict, fields, **kwargs)
+            flush_writes(coll)
+            it = coll.find(queryDict, fields, **kwargs)
+            if sortKeys:
+                it = it.sort(get_sort_list(sortKeys))
+            if skip:
+                it = it.skip(skip)
+            if limit:
+                it = it.limit(limit)
+            it = counted_iter('find', klass, it, queryDict)
         for d in it:
             if idOnly:
                 yield d['_id']
@@ -211,12 +1060,61 @@ class Document(object):
                 yield d
 
     @classmethod
-    def find_obj(klass, queryDict={}, **kwargs):
-        'same as find() but returns objects'
-        for d in klass.find(queryDict, None, False, **kwargs):
-            yield klass(docData=d, insertNew=False)
+    def find_obj(klass, queryDict={}, prefetch=(), fields=None,
+                 readOnly=False, **kwargs):
+        '''same as find() but returns objects.
+        prefetch lists LinkDescriptor attrs to batch-load for all results;
+        fields optionally restricts what is loaded, and readOnly loads
+        raw BSON and refuses writes, as in __init__()'''
+        l = []
+        initArgs = readOnly and dict(readOnly=True) or {}
+        for d in klass.find(queryDict, fields, False, readOnly=readOnly,
+                            **kwargs):
+            o = klass(docData=d, insertNew=False, **initArgs)
+            if fields:
+                o._fields = fields
+            elif klass.useIdentityMap and not readOnly:
+                remember_obj(o)
+            if not prefetch:
+                yield o
+            else: # must collect all results before prefetching
+                l.append(o)
+        for o in prefetch_links(l, prefetch):
+            yield o
     find_or_insert = classmethod(base_find_or_insert)
 
+    @classmethod
+    def get_page_keys(klass):
+        'list of (key, direction) for paging query results, newest first'
+        return [('_id', -1)]
+
+    def get_page_values(self, keys):
+        'values of page keys for this object'
+        return [self._dbDocDict[k.split('.')[-1]] for k, direction in keys]
+
+    @classmethod
+    def find_page(klass, queryDict={}, pageSize=20, pageToken=None,
+                  **kwargs):
+        '''get ResultsPage of up to pageSize objects from find_obj(),
+        continuing from pageToken (a previous page's nextToken).
+        Pages are selected by the keys in get_page_keys() rather than
+        by skip, so deep pages cost the same as the first.'''
+        keys = klass.get_page_keys()
+        if pageToken:
+            keyset = get_keyset_query(keys, decode_page_token(pageToken))
+            queryDict = queryDict and {'$and': [queryDict, keyset]} or keyset
+        l = list(klass.find_obj(queryDict, sortKeys=keys,
+                                limit=pageSize + 1, **kwargs))
+        return klass._results_page(l, keys, pageSize)
+
+    @classmethod
+    def _results_page(klass, l, keys, pageSize):
+        'return first pageSize of l, with nextToken if there are more'
+        if len(l) <= pageSize:
+            return ResultsPage(l)
+        l = l[:pageSize]
+        return ResultsPage(l, encode_page_token(l[-1].get_page_values(keys)))
+
 def convert_obj_to_id(d):
     'replace Document objects by their IDs'
     d = d.copy()
@@ -226,6 +1124,7 @@ def convert_obj_to_id(d):
     return d
 
 class EmbeddedDocBase(Document):
+    useIdentityMap = False # only top-level docs are kept in identity map
     def _set_parent(self, parent):
         if hasattr(parent, 'coll'):
             self._parent_link = parent._id # save its ID
@@ -267,8 +1166,9 @@ class EmbeddedDocument(EmbeddedDocBase):
     def _get_doc(self, fetchID):
         'retrieve DB array record containing this document'
         subdocField = self._dbfield.split('.')[0]
-        d = self.coll.find_one({self._dbfield: fetchID},
-                               {subdocField: 1, '_id':1})
+        flush_writes(self.coll)
+        d = timed_call('find_one', self.__class__, self.coll.find_one,
+                       {self._dbfield: fetchID}, {subdocField: 1, '_id':1})
         if not d:
             raise KeyError('no such record: _id=%s' % fetchID)
         self._parent_link = d['_id']
@@ -276,17 +1176,20 @@ class EmbeddedDocument(EmbeddedDocBase):
     def insert(self, d):
         subdocField = self._dbfield.split('.')[0]
         convert_times(d)
-        self.coll.update({'_id': self._parent_link},
-                         {'$set': {subdocField: convert_obj_to_id(d)}})
+        update_doc(self.coll, {'_id': self._parent_link},
+                   {'$set': {subdocField: convert_obj_to_id(d)}},
+                   source=self.__class__)
         self._dbDocDict = d
         self._isNewInsert = True
     def update(self, updateDict):
         'update the existing embedded doc fields in the parent document'
+        self.check_writable()
         subdocField = self._dbfield.split('.')[0]
         d = {}
         for k,v in updateDict.items():
             d[subdocField + '.' + k] = v
-        self.coll.update({'_id': self._parent_link}, {'$set': d})
+        update_doc(self.coll, {'_id': self._parent_link}, {'$set': d},
+                   source=self.__class__)
         self._dbDocDict.update(updateDict)
         self.set_attrs(updateDict)
     def __cmp__(self, other):
@@ -315,6 +1218,9 @@ def filter_array_docs(array, keyField, subID):
         if isinstance(v, list): # handle array fields specially
             if subID in v:
                 yield record
+            elif isinstance(subID, dict) and subID.keys() == ['$in']:
+                if set(v) & set(subID['$in']):
+                    yield record
         elif v == subID: # regular field
             yield record
         elif isinstance(subID, dict):
@@ -322,6 +1228,9 @@ def filter_array_docs(array, keyField, subID):
             if len(subquery) == 1 and subquery[0][0] == '$regex':
                 if re.search(subquery[0][1], v):
                     yield record
+            elif len(subquery) == 1 and subquery[0][0] == '$in':
+                if v in subquery[0][1]:
+                    yield record
             else:
                 raise ValueError('non-regex query ops not implemented')
         
@@ -332,7 +1241,10 @@ class ArrayDocument(EmbeddedDocBase):
     a Recommendation by (paperID,authorID).
     Subclasses MUST provide _dbfield attribute of the form
     field.subfield, indicating how to search for fetchID in the parent
-    document.'''
+    document.
+    To keep these (very numerous) records compact, their fields are not
+    copied as attributes: attribute reads are served from _dbDocDict.'''
+    useAggregate = True # select matching array records on the server
     def __init__(self, fetchID=None, docData=None, parent=None,
                  insertNew=True):
         self._set_parent(parent)
@@ -347,13 +1259,38 @@ class ArrayDocument(EmbeddedDocBase):
             except KeyError: # insert new record in database
                 fetchID = None
         Document.__init__(self, fetchID, docData, insertNew)
+    def __getattr__(self, attr):
+        'serve record fields (and LinkDescriptor link data) from _dbDocDict'
+        try:
+            d = self.__dict__['_dbDocDict']
+        except KeyError:
+            raise AttributeError(attr)
+        try:
+            if attr.startswith('_') and attr.endswith('_link'):
+                return convert_to_id(d[attr[1:-5]])
+            return d[attr]
+        except (KeyError, TypeError):
+            return Document.__getattr__(self, attr)
+    def set_attrs(self, d):
+        'drop stale attribute values for d; fields are read from _dbDocDict'
+        attrHandler = getattr(self, '_attrHandler', {})
+        klass = self.__class__
+        for attr, v in d.items():
+            self.__dict__.pop(attr, None) # e.g. link target from old data
+            if attr in attrHandler:
+                attrHandler[attr](self, attr, v)
+            elif isinstance(v, Document) and \
+                    isinstance(getattr(klass, attr, None), LinkDescriptor):
+                self.__dict__[attr] = v # bypass LinkDescriptor mechanism
     def _get_doc(self, fetchID):
         'retrieve DB array record containing this document'
         self._parent_link,subID = fetchID
         if getattr(self, 'useObjectId', False):
             self._parent_link = _get_object_id(self._parent_link)
         arrayField, keyField = self._dbfield.split('.')
-        d = self.coll.find_one(self._parent_link, {arrayField: 1})
+        flush_writes(self.coll)
+        d = timed_call('find_one', self.__class__, self.coll.find_one,
+                       self._parent_link, {arrayField: 1})
         if not d:
             raise KeyError('no such record: _id=%s' % self._parent_link)
         return find_one_array_doc(d[arrayField], keyField, subID)
@@ -372,55 +1309,116 @@ class ArrayDocument(EmbeddedDocBase):
             pass
         self._dbDocDict = d
         arrayField = self._dbfield.split('.')[0]
-        self.coll.update({'_id': self._parent_link},
-                         {'$push': {arrayField: convert_obj_to_id(d)}})
+        update_doc(self.coll, {'_id': self._parent_link},
+                   {'$push': {arrayField: convert_obj_to_id(d)}},
+                   source=self.__class__)
         self._isNewInsert = True
+    @classmethod
+    def append_many(klass, parent, docs, returnObjects=False):
+        '''append list of doc dicts to the target array in parent
+        using a single $push.  If returnObjects, return list of
+        objects constructed from them.  Classes that override insert()
+        (e.g. Post, to update topic feeds) are saved via insert(),
+        in one WriteSession'''
+        if not docs:
+            return []
+        if klass.insert.im_func is not ArrayDocument.insert.im_func:
+            with WriteSession(): # merges the $push writes where it can
+                l = [klass(docData=d, parent=parent) for d in docs]
+            if returnObjects:
+                return l
+            return
+        try: # parent can be either object or ID
+            parentID = parent._id
+        except AttributeError:
+            parentID = parent
+        timeStampField = getattr(klass, '_timeStampField', None)
+        l = []
+        for d in docs:
+            klass.check_required_fields(d)
+            if timeStampField and timeStampField not in d:
+                d[timeStampField] = datetime.utcnow() # add timestamp
+            l.append(convert_obj_to_id(d))
+        arrayField = klass._dbfield.split('.')[0]
+        update_doc(klass.coll, {'_id': parentID},
+                   {'$push': {arrayField: {'$each': l}}}, source=klass)
+        if returnObjects:
+            return [klass(docData=d, parent=parent, insertNew=False)
+                    for d in docs]
     def update(self, updateDict):
         'update the existing record in the array in the parent document'
+        self.check_writable()
         arrayField = self._dbfield.split('.')[0]
         d = {}
         for k,v in updateDict.items():
             d['.'.join((arrayField, '$', k))] = v
         subID = self._get_id()
-        self.coll.update({'_id': self._parent_link, self._dbfield: subID},
-                         {'$set': d})
+        update_doc(self.coll, {'_id': self._parent_link, self._dbfield: subID},
+                   {'$set': d}, source=self.__class__)
         self._dbDocDict.update(updateDict)
         self.set_attrs(updateDict)
 
     def delete(self):
         'delete this record from the array in the parent document'
+        self.check_writable()
         arrayField, keyField = self._dbfield.split('.')
         subID = self._get_id()
-        self.coll.update({'_id': self._parent_link},
-                         {'$pull': {arrayField: {keyField: subID}}})
+        update_doc(self.coll, {'_id': self._parent_link},
+                   {'$pull': {arrayField: {keyField: subID}}},
+                   source=self.__class__)
 
-    def _array_update(self, attr, l):
-        'replace attr array in db by the specified list l'
+    def _array_op(self, op, attr, v, returnNew=False):
+        """apply update op (e.g. $push) to the attr array of this record
+        in the db, without sending the whole array.  If returnNew,
+        return the updated array from the db"""
+        self.__dict__.pop(attr, None) # e.g. link target from old data
         arrayField = self._dbfield.split('.')[0]
-        subID = self._get_id()
-        target = '.'.join((arrayField, '$', attr))
-        self.coll.update({'_id': self._parent_link, self._dbfield: subID},
-                         {'$set': {target: l}})
+        spec = {'_id': self._parent_link, self._dbfield: self._get_id()}
+        doc = {op: {'.'.join((arrayField, '$', attr)): v}}
+        if not returnNew:
+            update_doc(self.coll, spec, doc, source=self.__class__)
+            return
+        forget_doc(self.coll, self._parent_link)
+        flush_writes(self.coll)
+        d = timed_call('find_and_modify', self.__class__,
+                       self.coll.find_and_modify, spec, doc, new=True,
+                       fields={arrayField + '.$': 1})
+        if not d:
+            raise KeyError('no such record: _id=%s' % self._parent_link)
+        l = d[arrayField][0].get(attr, [])
+        self._dbDocDict[attr] = l
+        return l
 
-    def array_append(self, attr, v):
-        'append v to array stored as attr'
+    def array_append(self, attr, v, returnNew=False):
+        """append v to array stored as attr, using a positional $push.
+        If returnNew, return the updated array from the db"""
+        self.check_writable()
         v = convert_to_id(v)
         try:
             self._dbDocDict[attr].append(v)
         except KeyError:
             self._dbDocDict[attr] = [v]
-        self._array_update(attr, self._dbDocDict[attr])
+        return self._array_op('$push', attr, v, returnNew)
 
-    def array_del(self, attr, v):
-        'remove element v from array stored as attr'
+    def array_add(self, attr, v, returnNew=False):
+        'add v to array stored as attr, unless already present ($addToSet)'
+        self.check_writable()
         v = convert_to_id(v)
-        l = self._dbDocDict[attr]
-        if del_list_value(l, v):
-            self._array_update(attr, l)
-        else:
-            raise IndexError('array %s does not contain %s'
-                             % (attr, str(v)))
-        
+        l = self._dbDocDict.setdefault(attr, [])
+        if v not in l:
+            l.append(v)
+        return self._array_op('$addToSet', attr, v, returnNew)
+
+    def array_del(self, attr, v, returnNew=False):
+        """remove element v from array stored as attr, using a
+        positional $pull.  If returnNew, return the updated array.
+        The $pull is sent even if our copy of the array lacks v,
+        since it may be stale"""
+        self.check_writable()
+        v = convert_to_id(v)
+        del_list_value(self._dbDocDict.get(attr, []), v)
+        return self._array_op('$pull', attr, v, returnNew)
+
     def __cmp__(self, other):
         try:
             return cmp((self._parent_link, self._get_id()),
@@ -436,8 +1434,19 @@ class ArrayDocument(EmbeddedDocBase):
 
     @classmethod
     def find(klass, queryDict={}, fields=None, idOnly=True, parentID=False,
-             **kwargs):
-        'generic class method for searching a specific collection'
+             sortKeys=None, limit=None, skip=None, readPreference=None,
+             readOnly=False, arrayMatch=None, **kwargs):
+        '''generic class method for searching a specific collection.
+        Array records matching queries on array subfields (e.g.
+        posts.author) are selected on the server by an $unwind
+        aggregation; if the server cannot do that, whole arrays are
+        retrieved and filtered in Python.  sortKeys, skip and limit
+        apply to the array records, so always use aggregation, as does
+        arrayMatch, an extra query on the records (with array prefix).
+        readOnly returns raw BSON records that decode fields lazily.'''
+        coll = klass.get_read_coll(readPreference)
+        if readOnly:
+            coll = get_raw_coll(coll)
         if fields:
             idOnly = False
         if idOnly:
@@ -446,33 +1455,148 @@ class ArrayDocument(EmbeddedDocBase):
         if not fields: # get this array
             fields = {arrayField:1}
         filters = []
+        arrayQuery = {}
         for k,v in queryDict.items():
             queryFields = k.split('.')
             if queryFields[0] == arrayField:
                 filters.append((queryFields[1], v))
+                arrayQuery[k] = v
         if not queryDict: # get docs containing this array
             queryDict = {arrayField: {'$exists':True}}
-        for d in klass.coll.find(queryDict, fields, **kwargs): # query db
+        if arrayMatch: # e.g. keyset query for the next page
+            arrayQuery = arrayQuery and {'$and': [arrayQuery, arrayMatch]} \
+                or arrayMatch
+            queryDict = {'$and': [queryDict, arrayMatch]} # can use indexes
+        records = None
+        if klass.useAggregate and (arrayQuery or sortKeys or limit or skip) \
+                and not kwargs or arrayMatch:
+            records = klass._find_aggregate(coll, queryDict, arrayQuery,
+                                            fields, sortKeys, limit, skip,
+                                            bool(arrayMatch))
+        if records is None: # fetch whole arrays and filter them here
+            records = klass._find_filter(coll, queryDict, filters, fields,
+                                         **kwargs)
+            if sortKeys or limit or skip: # so apply these here too
+                records = klass._sort_slice(records, sortKeys, limit, skip)
+        for d, d2 in records: # return the filtered results appropriately
+            if idOnly:
+                yield klass._id_only(d, d2, keyField)
+            elif parentID:
+                yield d['_id'], d2
+            else:
+                yield d2
+
+    @classmethod
+    def _find_aggregate(klass, coll, queryDict, arrayQuery, fields,
+                        sortKeys=None, limit=None, skip=None, required=False):
+        '''get iterator of (doc, record) from $match / $unwind / $match /
+        $project pipeline, or None if the server cannot run it'''
+        arrayField = klass._dbfield.split('.')[0]
+        pipeline = [{'$match': queryDict}, {'$unwind': '$' + arrayField}]
+        if arrayQuery:
+            pipeline.append({'$match': arrayQuery})
+        if sortKeys:
+            pipeline.append({'$sort': SON(get_sort_list(sortKeys))})
+        if skip:
+            pipeline.append({'$skip': skip})
+        if limit:
+            pipeline.append({'$limit': limit})
+        pipeline.append({'$project': fields})
+        try:
+            it = aggregate_iter(coll, pipeline)
+        except OperationFailure:
+            if sortKeys or limit or skip or required: # no fallback for these
+                raise
+            return None
+        return ((d, d[arrayField]) for d in it if arrayField in d)
+
+    @classmethod
+    def _find_filter(klass, coll, queryDict, filters, fields, **kwargs):
+        'get iterator of (doc, record) by filtering whole arrays in Python'
+        arrayField = klass._dbfield.split('.')[0]
+        flush_writes(coll)
+        it = coll.find(queryDict, fields, **kwargs)
+        for d in counted_iter('find', klass, it, queryDict): # query db
             try:
                 array = d[arrayField]
             except KeyError:
                 continue # not present in this record, so skip
             for k,v in filters: # apply filters consecutively
                 array = list(filter_array_docs(array, k, v))
-            for d2 in array: # return the filtered results appropriately
-                if idOnly:
-                    yield klass._id_only(d, d2, keyField)
-                elif parentID:
-                    yield d['_id'], d2
-                else:
-                    yield d2
+            for d2 in array:
+                yield d, d2
 
     @classmethod
-    def find_obj(klass, queryDict={}, **kwargs):
-        'same as find() but returns objects'
+    def _sort_slice(klass, records, sortKeys=None, limit=None, skip=None):
+        '''sort list of (doc, record) in Python as the $sort stage would
+        (keys with array prefix refer to the record), then skip / limit'''
         arrayField = klass._dbfield.split('.')[0]
-        for parentID, d in klass.find(queryDict, None, False, True, **kwargs):
-            yield klass(docData=d, parent=parentID, insertNew=False)
+        records = list(records)
+        def get_key(t, k):
+            fields = k.split('.')
+            if fields[0] == arrayField:
+                d, fields = t[1], fields[1:]
+            else:
+                d = t[0]
+            for f in fields:
+                try:
+                    d = d[f]
+                except (KeyError, TypeError):
+                    return None # missing sorts first, as in mongodb
+            return d
+        if sortKeys: # stable sort, least significant key first
+            for k, direction in reversed(get_sort_list(sortKeys)):
+                records.sort(key=lambda t:get_key(t, k),
+                             reverse=direction < 0)
+        start = skip or 0
+        if limit:
+            return records[start:start + limit]
+        return records[start:]
+
+    @classmethod
+    def find_obj(klass, queryDict={}, prefetch=(), readOnly=False,
+                 **kwargs):
+        '''same as find() but returns objects.
+        prefetch lists LinkDescriptor attrs to batch-load for all results;
+        readOnly loads raw BSON records and refuses writes to them'''
+        l = []
+        for parentID, d in klass.find(queryDict, None, False, True,
+                                      readOnly=readOnly, **kwargs):
+            o = klass(docData=d, parent=parentID, insertNew=False)
+            if readOnly:
+                o._readOnly = True
+            if not prefetch:
+                yield o
+            else: # must collect all results before prefetching
+                l.append(o)
+        for o in prefetch_links(l, prefetch):
+            yield o
+
+    @classmethod
+    def get_page_keys(klass):
+        'list of (key, direction) for paging records, newest first'
+        keys = [(klass._dbfield, -1)]
+        try:
+            arrayField = klass._dbfield.split('.')[0]
+            keys.insert(0, (arrayField + '.' + klass._timeStampField, -1))
+        except AttributeError: # no timestamp, so just use record ID
+            pass
+        return keys
+
+    @classmethod
+    def find_page(klass, queryDict={}, pageSize=20, pageToken=None,
+                  **kwargs):
+        '''get ResultsPage of up to pageSize records from find_obj(),
+        continuing from pageToken (a previous page's nextToken).
+        Pages are selected by the keys in get_page_keys() rather than
+        by skip, so deep pages cost the same as the first.'''
+        keys = klass.get_page_keys()
+        if pageToken: # only records after the token
+            values = decode_page_token(pageToken)
+            kwargs['arrayMatch'] = get_keyset_query(keys, values)
+        l = list(klass.find_obj(queryDict, sortKeys=keys,
+                                limit=pageSize + 1, **kwargs))
+        return klass._results_page(l, keys, pageSize)
 
     @classmethod
     def find_obj_in_parent(klass, parent, subID):
@@ -491,7 +1615,9 @@ class UniqueArrayDocument(ArrayDocument):
     def _get_doc(self, fetchID):
         'retrieve DB array record containing this document'
         arrayField, keyField = self._dbfield.split('.')
-        d = self.coll.find_one({self._dbfield: fetchID}, {arrayField: 1})
+        flush_writes(self.coll)
+        d = timed_call('find_one', self.__class__, self.coll.find_one,
+                       {self._dbfield: fetchID}, {arrayField: 1})
         if not d:
             raise KeyError('no such record: %s=%s' % (self._dbfield, fetchID))
         self._parent_link = d['_id'] # save parent ID
@@ -501,6 +1627,20 @@ class UniqueArrayDocument(ArrayDocument):
     def _id_only(klass, d, d2, keyField):
         return d2[keyField]
 
+    @classmethod
+    def _normalize_id(klass, fetchID):
+        return fetchID
+
+    @classmethod
+    def fetch_many(klass, fetchIDs, profile=None):
+        'get dict of {ID:obj} for all fetchIDs found, using one $in query'
+        found = {}
+        ids = [klass._normalize_id(fetchID) for fetchID in fetchIDs]
+        if ids:
+            for o in klass.find_obj({klass._dbfield: {'$in': ids}}):
+                found[o._get_id()] = o
+        return found
+
 class AutoIdArrayDocument(UniqueArrayDocument):
     'makes a unique ID automatically for you'
     def __init__(self, fetchID=None, docData=(), parent=None, insertNew=True):
@@ -515,6 +1655,20 @@ class AutoIdArrayDocument(UniqueArrayDocument):
             fetchID = ObjectId(fetchID)
         super(AutoIdArrayDocument, self).__init__(fetchID, docData, parent,
                                                   insertNew)
+
+    @classmethod
+    def _normalize_id(klass, fetchID):
+        return _get_object_id(fetchID)
+
+    @classmethod
+    def append_many(klass, parent, docs, returnObjects=False):
+        'create an ID for each doc lacking one, then append them'
+        keyField = klass._dbfield.split('.')[1]
+        for d in docs:
+            if keyField not in d:
+                d[keyField] = ObjectId() # use pymongo's ID generator
+        return super(AutoIdArrayDocument, klass).append_many(parent, docs,
+                                                             returnObjects)
             
 
 # generic retrieval classes
@@ -523,35 +1677,111 @@ class FetchObj(object):
     def __init__(self, klass, **kwargs):
         self.klass = klass
         self.kwargs = kwargs
-    def __call__(self, obj, fetchID):
-        return self.klass(fetchID, **self.kwargs)
+    def __call__(self, obj, fetchID, profile=None):
+        return self.klass.fetch(fetchID, profile, **self.kwargs)
+    def _get_link(self, obj, desc):
+        return desc.get_link(obj)
+    def _get_links(self, objs, desc):
+        'get list of (obj, linkData) for objs that have link data'
+        l = []
+        for o in objs:
+            try:
+                l.append((o, self._get_link(o, desc)))
+            except AttributeError:
+                pass
+        return l
+    def prefetch(self, objs, desc):
+        'batch-load link targets for objs, saving them as desc.attr'
+        if self.kwargs:
+            return # constructor args, so must fetch one by one
+        links = self._get_links(objs, desc)
+        found = self.klass.fetch_many(set([t[1] for t in links]),
+                                      desc.kwargs.get('profile'))
+        for o, fetchID in links:
+            try:
+                o.__dict__[desc.attr] = found[self.klass._normalize_id(fetchID)]
+            except KeyError: # let regular fetch on access report the error
+                pass
 
 
 class FetchList(FetchObj):
-    def __call__(self, obj, fetchIDs):
+    '''fetch list of objects using one $in query, in original order.
+    onMissing sets policy for IDs not found in the DB:
+    'raise' KeyError, 'skip' them, or 'none' to return None in their place'''
+    def __init__(self, klass, onMissing='raise', **kwargs):
+        FetchObj.__init__(self, klass, **kwargs)
+        self.onMissing = onMissing
+    def __call__(self, obj, fetchIDs, profile=None):
+        if self.kwargs: # constructor args, so must fetch one by one
+            return [self.klass.fetch(fetchID, profile, **self.kwargs)
+                    for fetchID in fetchIDs]
+        found = self.klass.fetch_many(fetchIDs, profile)
         l = []
         for fetchID in fetchIDs:
-            l.append(self.klass(fetchID, **self.kwargs))
+            try:
+                l.append(found[self.klass._normalize_id(fetchID)])
+            except KeyError:
+                if self.onMissing == 'skip':
+                    continue
+                elif self.onMissing == 'none':
+                    l.append(None)
+                else:
+                    raise KeyError('%s %s not found'
+                                   % (self.klass.__name__, fetchID))
         return l
+    def prefetch(self, objs, desc):
+        'batch-load link targets for objs, saving the lists as desc.attr'
+        if self.kwargs:
+            return
+        links = self._get_links(objs, desc)
+        allIDs = set()
+        for o, fetchIDs in links:
+            allIDs.update(fetchIDs)
+        found = self.klass.fetch_many(allIDs, desc.kwargs.get('profile'))
+        for o, fetchIDs in links:
+            l = []
+            for fetchID in fetchIDs:
+                try:
+                    l.append(found[self.klass._normalize_id(fetchID)])
+                except KeyError:
+                    if self.onMissing == 'skip':
+                        continue
+                    elif self.onMissing == 'none':
+                        l.append(None)
+                    else: # let regular fetch on access raise KeyError
+                        break
+            else:
+                o.__dict__[desc.attr] = l
 
 class FetchQuery(FetchObj):
-    def __init__(self, klass, queryFunc, **kwargs):
+    'prefetch lists link attrs to batch-load on all query results'
+    def __init__(self, klass, queryFunc, prefetch=(), readPreference=None,
+                 **kwargs):
         FetchObj.__init__(self, klass, **kwargs)
         self.queryFunc = queryFunc
+        self.prefetchAttrs = prefetch
+        self.readPreference = readPreference # else klass.readPreference
     def __call__(self, obj, **kwargs):
         query = self.queryFunc(obj, **kwargs)
-        return list(self.klass.find_obj(query))
+        return list(self.klass.find_obj(query, prefetch=self.prefetchAttrs,
+                                        readPreference=self.readPreference))
+    prefetch = None # results of a query cannot be batched by ID
 
 class FetchParent(FetchObj):
-    def __call__(self, obj):
-        return self.klass(obj._parent_link, **self.kwargs)
+    def __call__(self, obj, profile=None):
+        return self.klass.fetch(obj._parent_link, profile, **self.kwargs)
+    def _get_link(self, obj, desc):
+        return obj._parent_link
 
 class FetchObjByAttr(FetchObj):
     def __init__(self, klass, attr, **kwargs):
         self.attr = attr
         FetchObj.__init__(self, klass, **kwargs)
-    def __call__(self, obj):
-        return self.klass(getattr(obj, self.attr), **self.kwargs)
+    def __call__(self, obj, profile=None):
+        return self.klass.fetch(getattr(obj, self.attr), profile,
+                                **self.kwargs)
+    def _get_link(self, obj, desc):
+        return getattr(obj, self.attr)
 
 class SaveAttr(object):
     'unwrap dict using specified klass'
@@ -564,19 +1794,40 @@ class SaveAttr(object):
         kwargs = self.kwargs.copy()
         kwargs[self.arg] = obj
         o = self.klass(docData=data, **kwargs)
+        if obj._readOnly: # part of a read-only doc
+            o._readOnly = True
         if self.postprocess:
             self.postprocess(obj, attr, o)
         setattr(obj, attr, o)
 
 class SaveAttrList(SaveAttr):
-    'unwrap list of dicts using specified klass'
+    '''unwrap list of dicts using specified klass.
+    Unless lazy=False, the objects are only constructed the first time
+    obj.ATTR is accessed, so loading the parent doc stays cheap.'''
+    def __init__(self, klass, arg='parent', postprocess=None, lazy=True,
+                 **kwargs):
+        SaveAttr.__init__(self, klass, arg, postprocess, **kwargs)
+        self.lazy = lazy
     def __call__(self, obj, attr, data):
+        if not self.lazy:
+            return self.build(obj, attr, data)
+        obj.__dict__.pop(attr, None) # discard list built from older data
+        try:
+            obj.__dict__['_lazyAttrs'][attr] = (self, data)
+        except KeyError:
+            obj.__dict__['_lazyAttrs'] = {attr: (self, data)}
+    def build(self, obj, attr, data):
+        'construct the list of objects and save it as obj.ATTR'
         l = []
         for d in data:
             kwargs = self.kwargs.copy()
             kwargs[self.arg] = obj
-            l.append(self.klass(docData=d, **kwargs))
+            o = self.klass(docData=d, **kwargs)
+            if obj._readOnly: # part of a read-only doc
+                o._readOnly = True
+            l.append(o)
         if self.postprocess:
             self.postprocess(obj, attr, l)
         setattr(obj, attr, l)
+        return l
 
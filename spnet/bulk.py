@@ -1,5 +1,11 @@
 import core
-from datetime import datetime
+from base import update_doc, bulk_update, WriteSession, flush_writes, \
+     timed_call, remove_docs, forget_coll
+from datetime import datetime, timedelta
+import threading
+import random
+import logging
+import time
 
 def find_people_topics():
     'construct dict of person:topics from Recs, Posts, PaperInterests'
@@ -22,52 +28,456 @@ def find_people_topics():
 
 def insert_people_topics(peopleTopics):
     'add topics to each Person.topics array'
-    for personID,topics in peopleTopics.items():
-        core.Person.coll.update({'_id':personID},
-                                {'$addToSet': {'topics': {'$each':list(topics)}}})
+    with WriteSession(): # send as one bulk write
+        for personID,topics in peopleTopics.items():
+            update_doc(core.Person.coll, {'_id':personID},
+                       {'$addToSet': {'topics': {'$each':list(topics)}}},
+                       source=core.Person)
+            core.person_changed(personID, topics)
+    for personID,topics in peopleTopics.items(): # after the bulk write
+        core.rescore_deliveries(personID, topic=topics)
+
+subsFields = {'topics':1, 'topicOptions':1, 'subscriptions':1}
+
+def get_person_subs(d):
+    '''get (topics, hidden topics, authors) sets of recs to deliver
+    to Person doc dict d, or None if it has no topics or subscriptions'''
+    if not d.get('topics') and not d.get('subscriptions'):
+        return None
+    hideSet = set([dd['topic'] for dd in d.get('topicOptions', ())
+                   if dd.get('fromOthers', 0) == 'hide'])
+    topics = set(d.get('topics', ())) - hideSet # user doesn't want all recs
+    authors = set([sub['author'] for sub in d.get('subscriptions', ())])
+    return topics, hideSet, authors
 
 def get_people_subs():
     'get dicts of {topic:[subscribers]} and {person:[subscribers]}'
     topics = {}
     subs = {}
-    for d in core.Person.find({}, {'topics':1, 'topicOptions':1, 'subscriptions':1}):
+    for d in core.Person.find({}, subsFields):
+        entry = get_person_subs(d)
+        if entry is None:
+            continue
         personID = d['_id']
-        hideSet = set([dd['topic'] for dd in d.get('topicOptions', ())
-                       if dd.get('fromOthers', 0) == 'hide'])
-        for topic in d.get('topics', ()): # index topics this person wants to get
-            if topic in hideSet: # user doesn't want all recs on this topic
-                continue
-            try:
-                topics[topic].append(personID)
-            except KeyError:
-                topics[topic] = [personID]
-        for sub in d.get('subscriptions', ()): # index people this person wants to get
-            author = sub['author']
-            try:
-                subs[author].append(personID)
-            except KeyError:
-                subs[author] = [personID]
+        for topic in entry[0]: # index topics this person wants to get
+            topics.setdefault(topic, []).append(personID)
+        for author in entry[2]: # index people this person wants to get
+            subs.setdefault(author, []).append(personID)
     return topics, subs
 
-def deliver_rec(paperID, r, topics, subs):
-    author = r['author']
-    sigs = r.get('sigs', ())
-    docData = {'paper':paperID, 'from':author, 'topics':sigs,
-               'name':r.get('actor', {}).get('displayName', 'Unknown'),
-               'published':r.get('published', datetime.utcnow()),
-               'title':r.get('title', 'New Post'), 'post':r['id'],}
-    for personID in subs.get(author, ()): # deliver to subscribers
-        core.Person.coll.update({'_id':personID},
-                                {'$addToSet': {'received': docData}})
-    for topic in sigs:
-        for personID in topics.get(topic, ()): # deliver to subscribers
-            if personID == author: # don't deliver back to author!
-                continue
-            core.Person.coll.update({'_id':personID},
-                                    {'$addToSet': {'received': docData}})
+
+class SubscriptionIndex(object):
+    '''in-memory {topic:set(subscribers)} and {author:set(subscribers)}
+    index shared by ingest threads, kept up to date by
+    core.person_changed() instead of scanning all Person records'''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.topics = {}
+        self.subs = {}
+        self.people = {} # {personID:get_person_subs() entry}
+        self.changed = None # people changed during a rebuild()
+
+    def _add(self, personID, entry):
+        if entry is None:
+            return
+        self.people[personID] = entry
+        for topic in entry[0]:
+            self.topics.setdefault(topic, set()).add(personID)
+        for author in entry[2]:
+            self.subs.setdefault(author, set()).add(personID)
+
+    def _remove(self, personID):
+        try:
+            topics, hideSet, authors = self.people.pop(personID)
+        except KeyError:
+            return
+        for topic in topics:
+            self.topics[topic].discard(personID)
+        for author in authors:
+            self.subs[author].discard(personID)
+
+    def rebuild(self):
+        '''re-index all Person records; deliveries and updates can
+        continue on the old index in the meantime'''
+        with self.lock:
+            self.changed = set()
+        people = {}
+        for d in core.Person.find({}, subsFields):
+            people[d['_id']] = get_person_subs(d)
+        with self.lock:
+            changed, self.changed = self.changed, None
+            self.topics, self.subs, self.people = {}, {}, {}
+            for personID, entry in people.items():
+                self._add(personID, entry)
+        for personID in changed: # may have missed these changes
+            self.update_person(personID)
+
+    def start_rebuild(self):
+        'run rebuild() in a background thread'
+        t = threading.Thread(target=self.rebuild)
+        t.daemon = True
+        t.start()
+        return t
+
+    def update_person(self, personID, addTopics=None):
+        '''update index for a change in this person's settings.
+        addTopics lists topics just added, if that was the only change'''
+        with self.lock:
+            if self.changed is not None:
+                self.changed.add(personID)
+            if addTopics is not None and personID in self.people:
+                topics, hideSet, authors = self.people[personID]
+                self._remove(personID)
+                self._add(personID, (topics | (set(addTopics) - hideSet),
+                                     hideSet, authors))
+                return
+        flush_writes(core.Person.coll)
+        d = timed_call('find_one', core.Person, core.Person.coll.find_one,
+                       personID, subsFields)
+        with self.lock:
+            self._remove(personID)
+            if d:
+                self._add(personID, get_person_subs(d))
+
+    def get_recipients(self, author, topics, maxFanout=None, hot=None):
+        '''get set of personIDs to deliver a rec by author on topics.
+        Subscribers of an author or topic with more than maxFanout
+        subscribers are skipped, as for get_recipients() below'''
+        with self.lock:
+            return get_recipients({'from':author, 'topics':topics},
+                                  self.topics, self.subs, maxFanout, hot)
+
+    def check(self, sampleSize=20):
+        '''cheap consistency check: compare the number of people indexed
+        vs. the DB, and re-read a random sample of them, fixing any stale
+        entries.  Returns list of stale personIDs, or None if the
+        counts differ, i.e. a rebuild is needed'''
+        with self.lock:
+            n = len(self.people)
+            sample = random.sample(self.people.keys(), min(sampleSize, n))
+        query = {'$or': [{'topics.0': {'$exists': True}},
+                         {'subscriptions.0': {'$exists': True}}]}
+        flush_writes(core.Person.coll)
+        if timed_call('count', core.Person,
+                      core.Person.coll.find(query).count) != n:
+            return None
+        stale = []
+        for d in core.Person.find({'_id': {'$in': sample}}, subsFields):
+            entry = get_person_subs(d)
+            with self.lock:
+                if self.people.get(d['_id']) != entry:
+                    self._remove(d['_id'])
+                    self._add(d['_id'], entry)
+                    stale.append(d['_id'])
+        return stale
+
+subscriptionIndex = None
+_subscriptionIndexLock = threading.Lock()
+
+def get_subscription_index():
+    'get the shared SubscriptionIndex, building it on first use'
+    global subscriptionIndex
+    with _subscriptionIndexLock:
+        if subscriptionIndex is None:
+            index = SubscriptionIndex()
+            core.personChangeHooks.append(index.update_person)
+            index.rebuild()
+            subscriptionIndex = index
+    return subscriptionIndex
+
+def check_subscription_index(interval=300, sampleSize=20):
+    '''every interval sec, check the shared SubscriptionIndex against
+    the DB, which other processes (e.g. gplus polling) also change,
+    and rebuild it if it has drifted; run in separate thread'''
+    index = get_subscription_index()
+    while True:
+        time.sleep(interval)
+        try:
+            stale = index.check(sampleSize)
+            if stale is None or stale: # sample suggests more are stale
+                deliveryLogger.warning('subscription index drifted, '
+                                       'rebuilding')
+                index.rebuild() # keeps serving the old index meanwhile
+        except Exception:
+            deliveryLogger.exception('subscription index check failed')
+
+
+def get_recipients(docData, topics, subs, maxFanout=None, hot=None):
+    '''get set of personIDs to deliver received record docData to,
+    using topics, subs dicts from get_people_subs().  Subscribers of
+    an author or topic with more than maxFanout subscribers are
+    skipped, appending ('author', authorID) or ('topic', topic)
+    to list hot: they pull its stream instead (see core.HotFeed)'''
+    author = docData['from']
+    sources = [('author', author, subs.get(author, ()))] + \
+              [('topic', topic, topics.get(topic, ()))
+               for topic in docData['topics']]
+    people = set()
+    for kind, key, l in sources: # deliver to subscribers
+        if maxFanout is not None and len(l) > maxFanout:
+            if hot is not None:
+                hot.append((kind, key))
+        else:
+            people.update(l)
+    people.discard(author) # don't deliver back to author!
+    return people
+
+maxFanout = 10000 # followers pull posts from bigger authors / topics
+
+def get_delivery_levels(people):
+    'get {personID:priority levels} for the people receiving deliveries'
+    if not people:
+        return {}
+    return dict([(d['_id'], core.get_delivery_levels(d)) for d in
+                 core.Person.find({'_id': {'$in': list(people)}},
+                                  {'topics':1, 'topicOptions':1,
+                                   'subscriptions':1})])
+
+def get_delivery_updates(personID, l, levels):
+    '''get upserts that add received records l to the inbox of personID,
+    scored by its priority levels.  Re-delivering a post just
+    updates its existing inbox record'''
+    updates = []
+    for r in l:
+        d = dict(r, person=personID,
+                 priority=core.get_delivery_priority(r, levels))
+        updates.append(({'person':personID, 'post':r['post']},
+                        {'$set': d,
+                         '$setOnInsert': {'delivered': datetime.utcnow()}}))
+    return updates
+
+def send_deliveries(received, chunkSize=1000):
+    '''upsert {personID:[received records]} into inboxes, as unordered
+    bulk writes of up to chunkSize people each.  Returns counts of
+    (delivered, skipped), where skipped records were already in the inbox'''
+    delivered = skipped = 0
+    people = received.keys()
+    for i in range(0, len(people), chunkSize):
+        chunk = people[i:i + chunkSize]
+        levels = get_delivery_levels(chunk)
+        updates = []
+        for personID in chunk:
+            updates += get_delivery_updates(personID, received[personID],
+                                            levels.get(personID, ({}, {})))
+        result = bulk_update(core.Delivery.coll, updates, upsert=True,
+                             ordered=False, source=core.Delivery)
+        delivered += result['nUpserted']
+        skipped += result['nMatched']
+    return delivered, skipped
+
+def deliver_rec(paperID, r, topics=None, subs=None):
+    '''deliver rec r to its subscribers (except its author), looked up in
+    topics, subs dicts from get_people_subs(), or else the shared
+    SubscriptionIndex.  Returns counts of (delivered, skipped)'''
+    return deliver_rec_doc(core.get_rec_doc(paperID, r), topics, subs)
+
+def deliver_rec_doc(docData, topics=None, subs=None):
+    '''deliver received record docData, as for deliver_rec(), except
+    to followers of authors or topics with more than maxFanout'''
+    hot = []
+    if topics is None:
+        people = get_subscription_index().get_recipients(
+            docData['from'], docData['topics'], maxFanout, hot)
+    else:
+        people = get_recipients(docData, topics, subs, maxFanout, hot)
+    for kind, key in hot:
+        core.add_hot_feed(kind, key)
+    return send_deliveries(dict([(personID, [docData])
+                                 for personID in people]))
 
 
 def deliver_recs(topics, subs):
-    'insert appropriate recs to Person.received array records'
+    '''insert appropriate recs into each person's inbox, in chunked
+    bulk writes.  Returns counts of (delivered, skipped)'''
+    received = {}
+    hot = []
     for paperID, r in core.Post.find(idOnly=False, parentID=True):
-        deliver_rec(paperID, r, topics, subs)
+        docData = core.get_rec_doc(paperID, r)
+        for personID in get_recipients(docData, topics, subs, maxFanout,
+                                       hot):
+            received.setdefault(personID, []).append(docData)
+    for kind, key in set(hot):
+        core.add_hot_feed(kind, key)
+    return send_deliveries(received)
+
+
+deliveryLogger = logging.getLogger('spnet.delivery')
+
+class DeliveryQueue(object):
+    '''durable queue of deliveries, stored in the DeliveryJob collection
+    and run by a pool of worker threads (in one or more processes).
+    Jobs are keyed by post ID and delivery is an idempotent upsert,
+    so a job is simply retried if it fails or its worker dies.'''
+    def __init__(self, maxDepth=10000, leaseTime=300.,
+                 maxAttempts=5, retryDelay=60., pollInterval=1.,
+                 checkEvery=100, maxBackoff=60.):
+        '''put() delivers inline while maxDepth jobs are queued,
+        counting them in the DB only every checkEvery puts.
+        A claimed job is retried if not finished within leaseTime sec,
+        or retryDelay sec (times its number of attempts) after failing,
+        until it has failed maxAttempts times.  A worker that hits a
+        DB error waits (doubling up to maxBackoff sec) and carries on.'''
+        self.maxDepth = maxDepth
+        self.checkEvery = checkEvery
+        self.maxBackoff = maxBackoff
+        self._depth = None # as last counted in the DB
+        self._puts = 0 # since then
+        self.leaseTime = leaseTime
+        self.maxAttempts = maxAttempts
+        self.retryDelay = retryDelay
+        self.pollInterval = pollInterval
+        self.lock = threading.Lock()
+        self.counts = dict(queued=0, inline=0, done=0, retried=0, failed=0,
+                           delivered=0, skipped=0)
+        self.threads = []
+        self.running = False
+
+    def _count(self, key, n=1):
+        with self.lock:
+            self.counts[key] += n
+
+    def put(self, paperID, r):
+        '''queue delivery of rec r.  If the queue is full, deliver it
+        in this thread right away, rather than blocking the caller'''
+        if self.estimate_depth() >= self.maxDepth: # backpressure
+            self._count('inline')
+            return deliver_rec(paperID, r)
+        docData = core.get_rec_doc(paperID, r)
+        now = datetime.utcnow()
+        coll = core.DeliveryJob.coll
+        update_doc(coll, {'_id': docData['post']},
+                   {'$setOnInsert': dict(rec=docData, attempts=0,
+                                         queued=now, due=now)},
+                   upsert=True, source=core.DeliveryJob) # if already queued
+        self._count('queued')
+
+    def depth(self):
+        'number of jobs waiting or running (excluding failed jobs)'
+        coll = core.DeliveryJob.coll
+        return timed_call('count', core.DeliveryJob, coll.find(
+            {'attempts': {'$lt': self.maxAttempts}}).count)
+
+    def estimate_depth(self):
+        '''depth() as last counted, plus puts since then (an upper bound,
+        as we don't subtract finished jobs); recounted every checkEvery'''
+        with self.lock:
+            self._puts += 1
+            if self._depth is not None and self._puts < self.checkEvery:
+                return self._depth + self._puts
+        depth = self.depth()
+        with self.lock:
+            self._depth, self._puts = depth, 0
+        return depth
+
+    def claim(self):
+        'lease the next job that is due, or return None'
+        now = datetime.utcnow()
+        coll = core.DeliveryJob.coll
+        forget_coll(coll) # don't know which job we'll get
+        return timed_call('find_and_modify', core.DeliveryJob,
+                          coll.find_and_modify,
+                          {'due': {'$lte': now},
+                           'attempts': {'$lt': self.maxAttempts}},
+                          {'$set': {'due': now + timedelta(
+                              seconds=self.leaseTime)},
+                           '$inc': {'attempts': 1}},
+                          sort=[('due', 1)], new=True)
+
+    def run_job(self, job):
+        '''deliver the job, then remove it from the queue; on failure,
+        schedule a retry, or leave it marked failed after maxAttempts'''
+        coll = core.DeliveryJob.coll
+        try:
+            delivered, skipped = deliver_rec_doc(job['rec'])
+        except Exception:
+            deliveryLogger.exception('delivery of post %s failed (attempt %d)',
+                                     job['_id'], job['attempts'])
+            if job['attempts'] >= self.maxAttempts:
+                self._count('failed')
+                return False
+            due = datetime.utcnow() + timedelta(seconds=self.retryDelay
+                                                * job['attempts'])
+            update_doc(coll, {'_id': job['_id']}, {'$set': {'due': due}},
+                       source=core.DeliveryJob)
+            self._count('retried')
+            return False
+        remove_docs(coll, {'_id': job['_id'], 'attempts': job['attempts']},
+                    core.DeliveryJob)
+        with self.lock:
+            self.counts['done'] += 1
+            self.counts['delivered'] += delivered
+            self.counts['skipped'] += skipped
+        return True
+
+    def run_pending(self):
+        'run jobs that are due in this thread, until none left; return count'
+        n = 0
+        job = self.claim()
+        while job is not None:
+            self.run_job(job)
+            n += 1
+            job = self.claim()
+        return n
+
+    def work(self):
+        'worker thread loop: run jobs as they become due'
+        errors = 0 # consecutive
+        while self.running:
+            try:
+                job = self.claim()
+                if job is None:
+                    time.sleep(self.pollInterval)
+                else:
+                    self.run_job(job)
+                errors = 0
+            except Exception: # e.g. AutoReconnect during a failover
+                errors += 1
+                deliveryLogger.exception('delivery worker error (%d in a row)',
+                                         errors)
+                time.sleep(min(self.pollInterval * 2 ** errors,
+                               self.maxBackoff))
+
+    def start(self, nworkers=4):
+        'start a pool of nworkers worker threads'
+        self.running = True
+        for i in range(nworkers):
+            t = threading.Thread(target=self.work)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def stop(self):
+        'stop the worker threads after their current jobs'
+        self.running = False
+        self.threads = []
+
+    def get_stats(self):
+        '''get dict of queue depth, failed jobs, age (sec) of the oldest
+        waiting job, and counts of jobs handled by this process'''
+        coll = core.DeliveryJob.coll
+        with self.lock:
+            d = self.counts.copy()
+        d['depth'] = self.depth()
+        d['failedJobs'] = timed_call('count', core.DeliveryJob, coll.find(
+            {'attempts': {'$gte': self.maxAttempts}}).count)
+        d['oldest'] = 0.
+        for job in coll.find({'attempts': {'$lt': self.maxAttempts}},
+                             {'queued': 1}).sort('queued', 1).limit(1):
+            d['oldest'] = (datetime.utcnow() - job['queued']).total_seconds()
+        return d
+
+deliveryQueue = None # if None, deliver inline
+
+def start_delivery_workers(nworkers=4, **kwargs):
+    '''deliver new posts via a DeliveryQueue (created with kwargs)
+    run by nworkers threads, instead of inline during ingest'''
+    global deliveryQueue
+    deliveryQueue = DeliveryQueue(**kwargs)
+    deliveryQueue.start(nworkers)
+    return deliveryQueue
+
+def queue_delivery(paperID, r):
+    'deliver rec r via deliveryQueue if workers are running, else now'
+    if deliveryQueue is None:
+        return deliver_rec(paperID, r)
+    return deliveryQueue.put(paperID, r)
@@ -1,6 +1,6 @@
 
 from dbconn import DBConnection
-from core import Paper, Person, EmailAddress, Issue, IssueVote, SIG, GplusPersonData, Post, Reply, ArxivPaperData, PubmedPaperData, DoiPaperData, PaperInterest, GplusSubscriptions, Subscription, TopicOptions, Citation
+from core import Paper, Person, EmailAddress, Issue, IssueVote, SIG, GplusPersonData, Post, Reply, ArxivPaperData, PubmedPaperData, DoiPaperData, PaperInterest, GplusSubscriptions, Subscription, TopicOptions, Citation, Delivery, DeliveryJob, HotFeed, TopicFeed
 import json
 from pymongo.errors import ConnectionFailure
 
@@ -22,13 +22,18 @@ connectDict = {
     PaperInterest:'spnet.paper',
     Subscription:'spnet.person',
     TopicOptions:'spnet.person',
+    Delivery:'spnet.delivery',
+    DeliveryJob:'spnet.delivery_queue',
+    HotFeed:'spnet.hot_feed',
+    TopicFeed:'spnet.topic_feed',
     }
 
 
 
 def init_connection(spnetUrlBase='https://selectedpapers.net', 
                     dbconfFile='../mongodb/access.json', **kwargs):
-    'set klass.coll on each db class to give it db connection'
+    '''set klass.coll on each db class to give it db connection,
+    and create the indexes each class declares (unless ensureIndexes=False)'''
     try:
         with open(dbconfFile) as ifile:
             dbconfig = json.load(ifile)
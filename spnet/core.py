@@ -6,6 +6,8 @@ import errors
 import thread
 import latex
 import time
+import heapq
+import calendar
 
 
 ##########################################################
@@ -39,7 +41,7 @@ fetch_post = FetchObj(None)
 fetch_sig = FetchObj(None)
 fetch_sigs = FetchList(None)
 fetch_people = FetchList(None)
-fetch_papers = FetchList(None)
+fetch_papers = FetchList(None, onMissing='skip') # ignore deleted papers
 fetch_parent_issue = FetchParent(None)
 fetch_parent_person = FetchParent(None)
 fetch_parent_paper = FetchParent(None)
@@ -48,18 +50,24 @@ fetch_subscribers = FetchQuery(None, lambda person:
                                {'subscriptions.author':person._id})
 fetch_sig_members = FetchQuery(None, lambda sig: {'sigs.sig':sig._id})
 fetch_sig_papers = FetchQuery(None, lambda sig: {'sigs':sig._id})
-fetch_post_citations = FetchQuery(None, lambda post: {'citations.post':post.id})
+fetch_post_citations = FetchQuery(None, lambda post: {'citations.post':post.id},
+                                  prefetch=('parent',))
 fetch_sig_posts = FetchQuery(None, lambda sig:
-                            {'posts.sigs':sig._id})
+                            {'posts.sigs':sig._id},
+                             prefetch=('author', 'parent', 'sigs'))
 fetch_sig_interests = FetchQuery(None, lambda sig:
-                                 {'interests.topics':sig._id})
+                                 {'interests.topics':sig._id},
+                                 prefetch=('author', 'parent'))
 fetch_issues = FetchQuery(None, lambda paper:dict(paper=paper._id))
 fetch_person_posts = FetchQuery(None, lambda author:
-                            {'posts.author':author._id})
+                            {'posts.author':author._id},
+                                prefetch=('parent', 'sigs'))
 fetch_person_replies = FetchQuery(None, lambda author:
-                            {'replies.author':author._id})
+                            {'replies.author':author._id},
+                                  prefetch=('parent', 'replyTo'))
 fetch_person_interests = FetchQuery(None, lambda author:
-                            {'interests.author':author._id})
+                            {'interests.author':author._id},
+                                    prefetch=('parent',))
 fetch_gplus_by_id = FetchObjByAttr(None, '_id')
 fetch_gplus_subs = FetchObjByAttr(None, 'id')
 
@@ -67,6 +75,7 @@ fetch_gplus_subs = FetchObjByAttr(None, 'id')
 
 class EmailAddress(UniqueArrayDocument):
     _dbfield = 'email.address' # dot.name for updating
+    _indexes = [('email.address', dict(unique=True, sparse=True))]
 
     parent = LinkDescriptor('parent', fetch_parent_person, noData=True)
 
@@ -85,8 +94,19 @@ class AuthorInfo(object):
         else:
             return self.text
 
+personChangeHooks = [] # called as hook(personID, addTopics), see below
+
+def person_changed(personID, addTopics=None):
+    '''notify personChangeHooks that this person's topics, TopicOptions
+    or Subscriptions changed.  addTopics lists the topics added, if
+    that was the only change'''
+    for hook in personChangeHooks:
+        hook(personID, addTopics)
+
 def report_topics(self, d, attr='sigs', method='insert', personAttr='author'):
     'wrap insert() or update() to insert topics into author Person record'
+    if method == 'update':
+        self.check_writable() # before touching the Person record
     try:
         topics = d[attr]
     except KeyError:
@@ -96,18 +116,99 @@ def report_topics(self, d, attr='sigs', method='insert', personAttr='author'):
             personID = d[personAttr]
         except KeyError:
             personID = self._dbDocDict[personAttr]
-        Person.coll.update({'_id': personID},
-                           {'$addToSet': {'topics': {'$each':topics}}})
+        update_doc(Person.coll, {'_id': personID},
+                   {'$addToSet': {'topics': {'$each':topics}}}, source=Person)
+        rescore_deliveries(personID, topic=topics)
+        person_changed(personID, topics)
     return getattr(super(self.__class__, self), method)(d)
 
+class TopicFeed(Document):
+    '''copy of a post on one topic, written when the post is saved,
+    so a SIG page can list the topic's posts (newest first) without
+    loading the Paper documents that contain them.  A post with no
+    topics gets one entry with topic None, so that the author index
+    can serve every post by an author (see get_pulled_deliveries())'''
+    _indexes = [([('topic', 1), ('post', 1)], dict(unique=True)),
+                [('topic', 1), ('isRec', 1), ('published', -1), ('_id', -1)],
+                [('topic', 1), ('published', -1), ('_id', -1)], 'post',
+                'paper', [('author', 1), ('published', -1), ('_id', -1)]]
+    @classmethod
+    def get_page_keys(klass):
+        'list of (key, direction) for paging a feed, newest first'
+        return [('published', -1), ('_id', -1)]
+    def get_local_url(self):
+        return '/posts/' + str(self.post)
+    def get_author_url(self):
+        return '/people/' + str(self.author)
+    def get_text(self):
+        return latex.convert_tex_dollars(self.text)
+    def get_replies(self):
+        'first few replies copied into this entry, text ready for display'
+        return [dict(r, text=latex.convert_tex_dollars(r.get('text', '')))
+                for r in self._dbDocDict.get('replies', ())]
+    def get_reply_count(self):
+        return self._dbDocDict.get('nReplies', 0)
+
+feedReplies = 3 # number of replies copied into each TopicFeed entry
+
+def get_feed_reply(reply):
+    'dict of the reply fields shown on a topic page'
+    d = reply._dbDocDict
+    return dict(id=d['id'], author=d['author'],
+                authorName=reply.get_author_name(), text=d.get('text', ''),
+                published=d['published'])
+
+def get_feed_replies(paper, postID):
+    '''get (number of replies, first few reply dicts) for post postID
+    in paper, to copy into its TopicFeed entries'''
+    replies = [r for r in getattr(paper, 'replies', ())
+               if r._dbDocDict.get('replyTo') == postID]
+    replies.sort(key=lambda r:r.published)
+    return len(replies), [get_feed_reply(r) for r in replies[:feedReplies]]
+
+def add_to_topic_feeds(post, newPost=False):
+    '''copy the fields a topic page shows of post into the TopicFeed
+    of each of its topics (sigs), updating any existing copies.
+    A newPost has no replies, so we skip loading them'''
+    d = post._dbDocDict
+    topics = d.get('sigs', ()) or [None] # for its author's stream
+    paper = post.__dict__.get('parent') # if caller already loaded it
+    if paper is None:
+        paper = Paper(post._parent_link, fields=Paper.noArrays)
+    entry = dict(post=d['id'], paper=post._parent_link,
+                 paperTitle=getattr(paper, 'title', ''),
+                 paperURL=paper.get_value('local_url'), author=d['author'],
+                 authorName=post.get_author_name(),
+                 title=d.get('title', ''), text=d.get('text', ''),
+                 published=d['published'], isRec=post.is_rec(),
+                 sigs=list(d.get('sigs', ())))
+    if newPost:
+        entry['nReplies'], entry['replies'] = 0, []
+    else:
+        entry['nReplies'], entry['replies'] = get_feed_replies(paper, d['id'])
+    if 'url' in d:
+        entry['url'] = d['url']
+    bulk_update(TopicFeed.coll, [(dict(topic=topic, post=d['id']),
+                                  {'$set': dict(entry, topic=topic)})
+                                 for topic in topics],
+                upsert=True, ordered=False, source=TopicFeed)
+
+def remove_old_topic_feeds(post):
+    'remove TopicFeed copies of post for topics it no longer has'
+    remove_docs(TopicFeed.coll, {'post': post.id, 'topic': {
+        '$nin': list(post._dbDocDict.get('sigs', ()))}}, TopicFeed)
+
+
 class Post(UniqueArrayDocument, AuthorInfo):
     _dbfield = 'posts.id' # dot.name for updating
+    _indexes = [('posts.id', dict(unique=True, sparse=True)),
+                'posts.sigs', 'posts.author']
     _timeStampField = 'published' # auto-add timestamp if missing
     _parent_url = '/papers/%s' # link for full paper record
     # attrs that will only be fetched if accessed by getattr
     parent = LinkDescriptor('parent', fetch_parent_paper, noData=True)
     citations = LinkDescriptor('citations', fetch_post_citations, noData=True)
-    author = LinkDescriptor('author', fetch_person)
+    author = LinkDescriptor('author', fetch_person, profile='card')
     sigs = LinkDescriptor('sigs', fetch_sigs, missingData=())
     def get_replies(self):
         'get all replies for this post'
@@ -118,18 +219,33 @@ class Post(UniqueArrayDocument, AuthorInfo):
         for r in getattr(self.parent, 'replies', ()):
             if r._dbDocDict['replyTo'] == docID:
                 yield r
-    insert = lambda self,d:report_topics(self, d)
-    update = lambda self,d:report_topics(self, d, method='update')
+    def insert(self, d):
+        report_topics(self, d)
+        add_to_topic_feeds(self, newPost=True)
+    def update(self, d):
+        report_topics(self, d, method='update')
+        if 'sigs' in d: # drop feed copies for topics no longer tagged
+            remove_old_topic_feeds(self)
+        if set(d) & set(('sigs', 'title', 'text', 'citationType')):
+            add_to_topic_feeds(self)
     def get_topics(self):
         l = []
         for topicID in self._dbDocDict.get('sigs', ()):
             l.append(SIG(docData=dict(_id=topicID, name='#' + topicID), 
                          insertNew=False))
         return l
+    def _array_op(self, op, attr, v, returnNew=False):
+        'also keep our TopicFeed copies in step with changes to sigs'
+        result = UniqueArrayDocument._array_op(self, op, attr, v, returnNew)
+        if attr == 'sigs':
+            remove_old_topic_feeds(self)
+            add_to_topic_feeds(self)
+        return result
     def delete(self):
         for c in self.citations:
             c.delete()
         UniqueArrayDocument.delete(self)
+        remove_docs(TopicFeed.coll, {'post': self.id}, TopicFeed)
     def get_local_url(self):
         return '/posts/' + self.id
     def is_rec(self):
@@ -154,15 +270,58 @@ def fetch_reply_post(obj, fetchID):
             return post
     raise KeyError('No post found with id=' + str(fetchID))
 
+def prefetch_reply_posts(objs, desc):
+    '''resolve replyTo for each reply from its parent paper, with no
+    further queries if their parents were prefetched first'''
+    for o in objs:
+        try:
+            o.__dict__[desc.attr] = fetch_reply_post(o,
+                                                     o._dbDocDict[desc.attr])
+        except KeyError: # let regular fetch on access report the error
+            pass
+
+fetch_reply_post.prefetch = prefetch_reply_posts
+
 
 class Reply(UniqueArrayDocument, AuthorInfo):
     _dbfield = 'replies.id' # dot.name for updating
+    _indexes = [('replies.id', dict(unique=True, sparse=True)),
+                'replies.author']
     _timeStampField = 'published' # auto-add timestamp if missing
     _parent_url = '/papers/%s' # link for full paper record
     # attrs that will only be fetched if accessed by getattr
     parent = LinkDescriptor('parent', fetch_parent_paper, noData=True)
-    author = LinkDescriptor('author', fetch_person)
+    author = LinkDescriptor('author', fetch_person, profile='card')
     replyTo = LinkDescriptor('replyTo', fetch_reply_post)
+    def insert(self, d):
+        'also add to the TopicFeed copies of the post it replies to'
+        UniqueArrayDocument.insert(self, d)
+        if 'replyTo' not in d:
+            return
+        spec = {'post': d['replyTo']}
+        update_doc(TopicFeed.coll, spec, {'$inc': {'nReplies': 1}},
+                   multi=True, source=TopicFeed)
+        spec['replies.%d' % (feedReplies - 1)] = {'$exists': False}
+        update_doc(TopicFeed.coll, spec,
+                   {'$push': {'replies': get_feed_reply(self)}}, multi=True,
+                   source=TopicFeed)
+    def update(self, d):
+        UniqueArrayDocument.update(self, d)
+        if 'text' in d and 'replyTo' in self._dbDocDict:
+            update_doc(TopicFeed.coll, {'post': self._dbDocDict['replyTo'],
+                                        'replies.id': self.id},
+                       {'$set': {'replies.$.text': d['text']}}, multi=True,
+                       source=TopicFeed)
+    def delete(self):
+        'also recopy replies into the post\'s TopicFeed entries (backfill)'
+        UniqueArrayDocument.delete(self)
+        if 'replyTo' in self._dbDocDict:
+            postID = self._dbDocDict['replyTo']
+            nReplies, replies = get_feed_replies(Paper(self._parent_link),
+                                                 postID)
+            update_doc(TopicFeed.coll, {'post': postID},
+                       {'$set': dict(nReplies=nReplies, replies=replies)},
+                       multi=True, source=TopicFeed)
     def get_local_url(self):
         return self.get_post_url() + '#' + self.id
     def get_post_url(self):
@@ -170,30 +329,40 @@ class Reply(UniqueArrayDocument, AuthorInfo):
 
 class Citation(ArrayDocument):
     _dbfield = 'citations.post' # dot.name for updating
+    _indexes = ['citations.post']
     _timeStampField = 'published' # auto-add timestamp if missing
     # attrs that will only be fetched if accessed by getattr
-    parent = LinkDescriptor('parent', fetch_parent_paper, noData=True)
+    parent = LinkDescriptor('parent', fetch_parent_paper, noData=True,
+                            profile='summary')
     post = LinkDescriptor('post', fetch_post)
 
 
 class PaperInterest(ArrayDocument):
     _dbfield = 'interests.author' # dot.name for updating
+    _indexes = ['interests.author', 'interests.topics']
     # attrs that will only be fetched if accessed by getattr
-    parent = LinkDescriptor('parent', fetch_parent_paper, noData=True)
-    author = LinkDescriptor('author', fetch_person)
+    parent = LinkDescriptor('parent', fetch_parent_paper, noData=True,
+                            profile='summary')
+    author = LinkDescriptor('author', fetch_person, profile='card')
     topics = LinkDescriptor('topics', fetch_sigs, missingData=())
     insert = lambda self,d:report_topics(self, d, 'topics')
     update = lambda self,d:report_topics(self, d, 'topics', method='update')
     def add_topic(self, topic):
-        topics = set(self._dbDocDict.get('topics', ()))
-        topics.add(topic)
-        self.update(dict(topics=list(topics)))
+        self.array_add('topics', topic)
+        update_doc(Person.coll, {'_id': self._dbDocDict['author']},
+                   {'$addToSet': {'topics': topic}},
+                   source=Person) # as report_topics()
+        rescore_deliveries(self._dbDocDict['author'], topic=topic)
+        person_changed(self._dbDocDict['author'], [topic])
         return self
     def remove_topic(self, topic):
-        topics = set(self._dbDocDict.get('topics', ()))
-        topics.remove(topic)
+        if topic not in self._dbDocDict.get('topics', ()): # may be stale
+            fresh = self.__class__((self._parent_link,
+                                    self._dbDocDict['author']))
+            if topic not in fresh._dbDocDict.get('topics', ()):
+                raise KeyError('topic %s not in PaperInterest' % topic)
+        topics = self.array_del('topics', topic, returnNew=True)
         if topics:
-            self.update(dict(topics=list(topics)))
             return self
         else: # PaperInterest empty, so remove completely
             self.delete()
@@ -204,12 +373,14 @@ class PaperInterest(ArrayDocument):
 
 class IssueVote(ArrayDocument):
     _dbfield = 'votes.person' # dot.name for updating
+    _indexes = ['votes.person']
     person = LinkDescriptor('person', fetch_person)
     parent = LinkDescriptor('parent', fetch_parent_issue, noData=True)
 
 
 class Issue(Document):
     '''interface for a question raised about a paper '''
+    _indexes = ['paper']
 
     # attrs that will only be fetched if accessed by user
     paper = LinkDescriptor('paper', fetch_paper)
@@ -250,14 +421,71 @@ class SIG(Document):
             published = datetime.utcnow() # ensure timestamp
         return base_find_or_insert(klass, fetchID, name='#' + fetchID,
                                    published=published, **kwargs)
-    def get_interests(self):
-        'return dict of paper:[people]'
+    def get_feed_page(self, isRec=None, pageSize=20, pageToken=None):
+        '''get ResultsPage of TopicFeed posts on this topic, newest first,
+        only recommendations (isRec=True) or discussions (False), if given'''
+        queryDict = {'topic': self._id}
+        if isRec is not None:
+            queryDict['isRec'] = isRec
+        return TopicFeed.find_page(queryDict, pageSize, pageToken)
+    def get_interests(self, limit=None):
+        '''return dict of paper:[people], using one $group aggregation
+        that returns just the paper and people fields we display.
+        If limit, only the limit papers with most people, in that order'''
+        match = {'interests.topics': self._id}
+        pipeline = [{'$match': match}, {'$unwind': '$interests'},
+                    {'$match': match},
+                    {'$group': {'_id': {'_id': '$_id', 'title': '$title',
+                                        'authorNames': '$authorNames',
+                                        'arxiv': '$arxiv.id',
+                                        'pubmed': '$pubmed.id',
+                                        'doi': '$doi.id'}, # same for paper
+                                'n': {'$sum': 1},
+                                'people': {'$push': '$interests.author'}}},
+                    {'$sort': SON([('n', -1), ('_id._id', 1)])}]
+        if limit:
+            pipeline.append({'$limit': limit})
+        try:
+            it = aggregate_iter(Paper.coll, pipeline)
+        except OperationFailure: # server cannot aggregate
+            return self._get_interests_slow(limit)
+        results = list(it)
+        personIDs = set([personID for r in results
+                         for personID in r['people']])
+        names = {} # get all their names in one query
+        if personIDs:
+            for p in Person.find({'_id': {'$in': list(personIDs)}},
+                                 {'name': 1}, idOnly=False):
+                names[p['_id']] = p.get('name', 'user')
+        paperFields = dict(title=1, authorNames=1, arxiv=1, pubmed=1, doi=1)
+        d = OrderedDict()
+        for r in results:
+            key = r['_id']
+            paperData = dict(_id=key['_id'], title=key.get('title', ''),
+                             authorNames=key.get('authorNames', []))
+            for attr in Paper._get_value_attrs:
+                if key.get(attr) is not None: # for get_value() URLs
+                    paperData[attr] = dict(id=key[attr])
+            # partial docs: other attrs are loaded from the db on access
+            paper = Paper(docData=paperData, insertNew=False,
+                          fields=paperFields)
+            d[paper] = [Person(docData=dict(_id=personID,
+                                            name=names.get(personID, 'user')),
+                               insertNew=False, fields=dict(name=1))
+                        for personID in r['people']]
+        return d
+    def _get_interests_slow(self, limit=None):
+        'get_interests() by loading each PaperInterest, paper and person'
         d = {}
         for interest in self.interests:
             try:
                 d[interest.parent].append(interest.author)
             except KeyError:
                 d[interest.parent] = [interest.author]
+        if limit:
+            l = d.items()
+            l.sort(key=lambda t:len(t[1]), reverse=True)
+            d = OrderedDict(l[:limit])
         return d
     def get_local_url(self):
         return '/topics/' + str(self._id)
@@ -267,10 +495,23 @@ class SIG(Document):
 class TopicOptions(ArrayDocument):
     _dbfield = 'topicOptions.topic' # dot.name for updating
     topic = LinkDescriptor('topic', fetch_sig)
+    def insert(self, d):
+        ArrayDocument.insert(self, d)
+        rescore_deliveries(self._parent_link, topic=d['topic'])
+        person_changed(self._parent_link)
+    def update(self, updateDict):
+        ArrayDocument.update(self, updateDict)
+        rescore_deliveries(self._parent_link, topic=self._get_id())
+        person_changed(self._parent_link)
+    def delete(self):
+        ArrayDocument.delete(self)
+        rescore_deliveries(self._parent_link, topic=self._get_id())
+        person_changed(self._parent_link)
 
 class GplusPersonData(EmbeddedDocument):
     'store Google+ data for a user as subdocument of Person'
     _dbfield = 'gplus.id'
+    _indexes = [('gplus.id', dict(unique=True, sparse=True))]
     parent = LinkDescriptor('parent', fetch_parent_person, noData=True)
     subscriptions = LinkDescriptor('subscriptions', fetch_gplus_subs,
                                    noData=True)
@@ -340,6 +581,7 @@ class GplusSubscriptions(Document):
     'for a gplus member, store his array of gplus subscriptions (his circles)'
     useObjectId = False # input data will supply _id
     _subscriptionIdField = 'subs.id' # query to find a subscription by ID
+    _indexes = ['subs.id']
     gplusPerson = LinkDescriptor('gplusPerson', fetch_gplus_by_id,
                                  noData=True)
     def update_subscriptions(self, doc, subs):
@@ -365,15 +607,185 @@ def get_interests_sorted(d):
 
 class Subscription(ArrayDocument):
     _dbfield = 'subscriptions.author' # dot.name for updating
+    _indexes = ['subscriptions.author']
     # attrs that will only be fetched if accessed by user
-    author = LinkDescriptor('author', fetch_person)
+    author = LinkDescriptor('author', fetch_person, profile='card')
     topics = LinkDescriptor('topics', fetch_sigs, missingData=())
+    def insert(self, d):
+        ArrayDocument.insert(self, d)
+        rescore_deliveries(self._parent_link, author=d['author'])
+        person_changed(self._parent_link)
+    def update(self, updateDict):
+        ArrayDocument.update(self, updateDict)
+        rescore_deliveries(self._parent_link, author=self._get_id())
+        person_changed(self._parent_link)
+    def delete(self):
+        ArrayDocument.delete(self)
+        rescore_deliveries(self._parent_link, author=self._get_id())
+        person_changed(self._parent_link)
+
+
+
+deliveryOrder = dict(hide=0, low=1, medium=2, high=3)
+deliverySort = [('priority', -1), ('published', -1)] # Person.get_deliveries
+
+def get_delivery_levels(d, order=deliveryOrder):
+    '''get ({topic:(fromMySubs, fromOthers)}, {author:(onMyTopics, onOthers)})
+    priority levels from topics, topicOptions and subscriptions of
+    Person doc dict d'''
+    topicOptions = dict([(t['topic'], t) for t in d.get('topicOptions', ())])
+    topics = {}
+    for topic in d.get('topics', ()):
+        tOpt = topicOptions.get(topic, {})
+        fromMySubs = order[tOpt.get('fromMySubs', 'medium')]
+        fromOthers = tOpt.get('fromOthers', 'low')
+        if fromOthers == 'same':
+            fromOthers = fromMySubs
+        else:
+            fromOthers = order[fromOthers]
+        if fromMySubs > 0:
+            topics[topic] = (fromMySubs, fromOthers)
+    subs = {}
+    for sub in d.get('subscriptions', ()):
+        subs[sub['author']] = (sub.get('onMyTopics', 'topic'),
+                               sub.get('onOthers', 'low'))
+    return topics, subs
+
+def get_delivery_priority(r, levels, order=deliveryOrder):
+    'compute priority of received record r for get_delivery_levels() levels'
+    topics, subs = levels
+    try:
+        sub = subs[r['from']]
+        i = 0
+    except KeyError:
+        sub = None
+        i = 1
+    priority = 0
+    for topic in r['topics']:
+        try:
+            priority = max(priority, topics[topic][i])
+        except KeyError:
+            pass
+    if sub:
+        if priority > 0:
+            level = sub[0]
+        else:
+            level = sub[1]
+        if level != 'topic':
+            priority = max(priority, order[level])
+    return priority
+
+def rescore_deliveries(personID, author=None, topic=None):
+    '''recompute priority of inbox records from author or on topic
+    (a topic ID or list of them), or all of them if neither specified,
+    after a change in the person's settings or topics'''
+    flush_writes(Person.coll)
+    d = timed_call('find_one', Person, Person.coll.find_one, personID,
+                   dict(topics=1, topicOptions=1, subscriptions=1))
+    if not d:
+        return 0
+    levels = get_delivery_levels(d)
+    query = {'person': personID}
+    if author is not None:
+        query['from'] = author
+    elif isinstance(topic, (list, tuple, set)):
+        query['topics'] = {'$in': list(topic)}
+    elif topic is not None:
+        query['topics'] = topic
+    updates = []
+    for r in Delivery.find(query, {'from':1, 'topics':1, 'priority':1}):
+        priority = get_delivery_priority(r, levels)
+        if priority != r.get('priority'):
+            updates.append(({'_id': r['_id']},
+                            {'$set': {'priority': priority}}))
+    bulk_update(Delivery.coll, updates, source=Delivery)
+    return len(updates)
+
+def get_rec_doc(paperID, r):
+    'get received record for rec r'
+    return {'paper':paperID, 'from':r['author'], 'topics':r.get('sigs', ()),
+            'name':r.get('actor', {}).get('displayName', 'Unknown'),
+            'published':r.get('published', datetime.utcnow()),
+            'title':r.get('title', 'New Post'), 'post':r['id'],}
+
+def get_feed_rec_doc(r):
+    'get received record for TopicFeed entry r'
+    return {'paper':r['paper'], 'from':r['author'], 'topics':r['sigs'],
+            'name':r.get('authorName', 'Unknown'),
+            'published':r['published'],
+            'title':r.get('title') or 'New Post', 'post':r['post'],}
 
+def get_delivery_key(r):
+    'sort key for received records, highest (priority, published) first'
+    t = r['published']
+    return (-r.get('priority', 0),
+            -(calendar.timegm(t.utctimetuple()) + t.microsecond / 1e6))
+
+def merge_deliveries(streams, n):
+    '''k-way merge of lists of received records, each in deliverySort
+    order, to get the top n, skipping duplicate posts'''
+    it = heapq.merge(*[[(get_delivery_key(r), i, j, r)
+                        for j, r in enumerate(l)]
+                       for i, l in enumerate(streams)])
+    posts = set()
+    l = []
+    for key, i, j, r in it:
+        if r['post'] not in posts:
+            posts.add(r['post'])
+            l.append(r)
+            if len(l) >= n:
+                break
+    return l
+
+_hotFeeds = [0., frozenset()] # [time loaded, set of (kind, key)]
+
+def get_hot_feeds(maxAge=60.):
+    'get set of HotFeed (kind, key) pairs, re-read every maxAge seconds'
+    if time.time() - _hotFeeds[0] > maxAge:
+        _hotFeeds[:] = [time.time(), frozenset([(d['kind'], d['key']) for d
+                                                in HotFeed.find(idOnly=False)])]
+    return _hotFeeds[1]
+
+def add_hot_feed(kind, key):
+    'mark author or topic stream to be pulled by its followers'
+    if (kind, key) in get_hot_feeds():
+        return
+    update_doc(HotFeed.coll, dict(kind=kind, key=key),
+               {'$set': dict(kind=kind, key=key)}, upsert=True, source=HotFeed)
+    _hotFeeds[0] = 0. # reload
+
+def fetch_deliveries(person):
+    'get all records in person\'s inbox, in deliverySort order'
+    return list(Delivery.find({'person': person._id}, idOnly=False,
+                              sortKeys=deliverySort))
+
+
+class Delivery(Document):
+    '''a post delivered to one person's inbox, stored in its own
+    collection, one record per (person, post)'''
+    _indexes = [([('person', 1), ('post', 1)], dict(unique=True)),
+                [('person', 1), ('priority', -1), ('published', -1)],
+                'paper', # dbclean
+                ('delivered', dict(expireAfterSeconds=180 * 24 * 3600))]
+
+
+class HotFeed(Document):
+    '''an author or topic with too many followers to push copies of its
+    posts to each inbox; Person.get_deliveries() pulls its stream'''
+    _indexes = [([('kind', 1), ('key', 1)], dict(unique=True))]
+
+
+class DeliveryJob(Document):
+    '''a post waiting in bulk.DeliveryQueue to be delivered,
+    keyed by post ID'''
+    useObjectId = False
+    _indexes = ['due', [('attempts', 1), ('due', 1)]] # claim(), depth()
 
 
 class Person(Document):
     '''interface to a stable identity tied to a set of publications '''
     _requiredFields = ('name',)
+    _indexes = ['sigs.sig'] # SIG.members
     # attrs that will only be fetched if accessed by user
     papers = LinkDescriptor('papers', fetch_author_papers, noData=True)
     recommendations = LinkDescriptor('recommendations', fetch_recs,
@@ -383,7 +795,9 @@ class Person(Document):
     posts = LinkDescriptor('posts', fetch_person_posts, noData=True)
     replies = LinkDescriptor('replies', fetch_person_replies, noData=True)
     interests = LinkDescriptor('interests', fetch_person_interests, noData=True)
-    readingList = LinkDescriptor('readingList', fetch_papers, missingData=())
+    readingList = LinkDescriptor('readingList', fetch_papers, missingData=(),
+                                 profile='summary')
+    received = LinkDescriptor('received', fetch_deliveries, noData=True)
 
     # custom attr constructors
     _attrHandler = dict(
@@ -392,7 +806,15 @@ class Person(Document):
         subscriptions = SaveAttrList(Subscription, insertNew=False),
         topicOptions = SaveAttrList(TopicOptions, insertNew=False),
         )
+    # named projections for LinkDescriptor(..., profile=NAME);
+    # any other attr is loaded transparently when first accessed
+    _profiles = dict(card=dict(name=1, gplus=1))
 
+    def update(self, updateDict, op='$set'):
+        Document.update(self, updateDict, op)
+        if set(updateDict) & set(('topics', 'subscriptions', 'topicOptions')):
+            rescore_deliveries(self._id) # e.g. G+ subscriptions sync
+            person_changed(self._id)
     def authenticate(self, password):
         try:
             return self.password == sha1(password).hexdigest()
@@ -418,7 +840,8 @@ class Person(Document):
         '''when Person first inserted to db, connect to pending
         subscriptions by appending our new personID.'''
         for subID in klass.find({klass._subscriptionIdField: subscriptionID}):
-            p = self.coll.find_one({'gplus.id': subID}, {'_id':1})
+            p = timed_call('find_one', self.__class__, self.coll.find_one,
+                           {'gplus.id': subID}, {'_id':1})
             if p is not None:
                 personID = p['_id']
                 Subscription((personID, self._id), docData=docData,
@@ -438,46 +861,51 @@ class Person(Document):
         l.sort(lambda x,y:cmp(order.get(x[1], -1), order.get(y[1], -1)), 
                reverse=True)
         return l
-    def get_deliveries(self, order = dict(hide=0, low=1, medium=2, high=3)):
-        topics = {}
-        for topic, fromMySubs, fromOthers in self.get_topics():
-            fromMySubs = order[fromMySubs]
-            if fromOthers == 'same':
-                fromOthers = fromMySubs
+    def get_deliveries(self, n=100):
+        '''get the top n records (with priority > 0) for our inbox,
+        in order of (priority, published): the records pushed to our
+        Delivery inbox (one indexed query) merged with those pulled
+        from any HotFeed streams we follow'''
+        inbox = list(Delivery.find({'person': self._id,
+                                    'priority': {'$gt': 0}}, idOnly=False,
+                                   sortKeys=deliverySort, limit=n))
+        streams = self.get_pulled_deliveries(n)
+        if not streams:
+            return inbox
+        return merge_deliveries([inbox] + streams, n)
+    def get_pulled_deliveries(self, n=100):
+        '''get list of received record lists (each in deliverySort
+        order) of the latest n posts in each HotFeed stream we follow'''
+        hot = get_hot_feeds()
+        if not hot:
+            return []
+        flush_writes(self.coll)
+        d = timed_call('find_one', self.__class__, self.coll.find_one,
+                       self._id, dict(topics=1, topicOptions=1,
+                                      subscriptions=1))
+        levels = get_delivery_levels(d or {})
+        streams = []
+        for kind, key in hot: # read from indexed TopicFeed streams
+            if kind == 'author' and key in levels[1]:
+                query = {'author': key}
+            elif kind == 'topic' and key in levels[0]:
+                query = {'topic': key}
             else:
-                fromOthers = order[fromOthers]
-            if fromMySubs > 0:
-                topics[topic] = (fromMySubs, fromOthers)
-        subs = {}
-        for s in getattr(self, 'subscriptions', ()):
-            subs[s._get_id()] = s
-        priority = 0
-        l = []
-        for r in getattr(self, 'received', ()):
-            try:
-                sub = subs[r['from']]
-                i = 0
-            except KeyError:
-                sub = None
-                i = 1
-            for topic in r['topics']:
-                try:
-                    priority = max(priority, topics[topic][i])
-                except KeyError:
-                    pass
-            if sub:
-                if priority > 0:
-                    level = getattr(sub, 'onMyTopics', 'topic')
-                else:
-                    level = getattr(sub, 'onOthers', 'low')
-                if level != 'topic':
-                    priority = max(priority, order[level])
-            if priority > 0:
-                r['priority'] = priority
-                l.append(r)
-        l.sort(lambda x,y:cmp((x['priority'],x['published']), 
-                              (y['priority'],y['published'])), reverse=True)
-        return l
+                continue # we don't follow this stream
+            l = []
+            seen = set() # author entries repeat a post for each topic
+            for r in TopicFeed.find(query, idOnly=False, limit=n,
+                                    sortKeys=TopicFeed.get_page_keys()):
+                if r['author'] == self._id or r['post'] in seen:
+                    continue # don't deliver back to author!
+                seen.add(r['post'])
+                rec = get_feed_rec_doc(r)
+                rec['priority'] = get_delivery_priority(rec, levels)
+                if rec['priority'] > 0:
+                    l.append(rec)
+            l.sort(key=get_delivery_key)
+            streams.append(l)
+        return streams
     def force_reload(self, state=None, delay=300):
         if state is not None:
             self._forceReload = state
@@ -494,6 +922,7 @@ class Person(Document):
 class ArxivPaperData(EmbeddedDocument):
     'store arxiv data for a paper as subdocument of Paper'
     _dbfield = 'arxiv.id'
+    _indexes = [('arxiv.id', dict(unique=True, sparse=True))]
     def __init__(self, fetchID=None, docData=None, parent=None,
                  insertNew=True):
         if fetchID:
@@ -534,6 +963,7 @@ class ArxivPaperData(EmbeddedDocument):
 class PubmedPaperData(EmbeddedDocument):
     'store pubmed data for a paper as subdocument of Paper'
     _dbfield = 'pubmed.id'
+    _indexes = [('pubmed.id', dict(unique=True, sparse=True))]
     def _query_external(self, pubmedID):
         'obtain pubmed doc data from NCBI'
         import pubmed
@@ -568,6 +998,8 @@ class PubmedPaperData(EmbeddedDocument):
 class DoiPaperData(EmbeddedDocument):
     'store DOI data for a paper as subdocument of Paper'
     _dbfield = 'doi.id'
+    _indexes = [('doi.id', dict(unique=True, sparse=True)),
+                ('doi.DOI', dict(sparse=True))]
     def __init__(self, fetchID=None, docData=None, parent=None,
                  insertNew=True, DOI=None, getPubmed=False):
         '''Note the fetchID must be shortDOI; to search for DOI, pass
@@ -577,7 +1009,8 @@ class DoiPaperData(EmbeddedDocument):
         self._getPubmed = getPubmed
         if fetchID is None and DOI: # must convert to shortDOI
             # to implement case-insensitive search, convert to uppercase
-            d = self.coll.find_one({'doi.DOI':DOI.upper()}, {'doi':1})
+            d = timed_call('find_one', self.__class__, self.coll.find_one,
+                           {'doi.DOI':DOI.upper()}, {'doi':1})
             if d: # found DOI in our DB
                 insertNew = False 
                 docData = d['doi']
@@ -639,6 +1072,7 @@ class DoiPaperData(EmbeddedDocument):
 
 class Paper(Document):
     '''interface to a specific paper '''
+    _indexes = ['authors', 'sigs'] # Person.papers, SIG.papers
     # attrs that will only be fetched if accessed by user
     authors = LinkDescriptor('authors', fetch_people)
     references = LinkDescriptor('references', fetch_papers,
@@ -660,6 +1094,9 @@ class Paper(Document):
         doi=SaveAttr(DoiPaperData, insertNew=False),
         )
     _get_value_attrs = ('arxiv', 'pubmed', 'doi')
+    # projection for loading a paper without its discussion arrays
+    noArrays = dict(posts=0, replies=0, citations=0, interests=0)
+    _profiles = dict(summary=noArrays)
     def get_interests(self, people=None, sorted=False):
         'return dict of {topicID:[person,]}'
         d = {}
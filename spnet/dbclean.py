@@ -1,5 +1,7 @@
 import core
 import incoming
+import bulk
+from base import bulk_update, update_doc, remove_docs
 
 ##############################################################
 # utilities for converting old Paper.recommendations storage
@@ -9,7 +11,8 @@ import incoming
 
 def delete_recs(q={'recommendations':{'$exists':True}}):
     'delete the old Paper.recommendations storage'
-    core.Paper.coll.update(q, {'$unset': {'recommendations':''}}, multi=True)
+    update_doc(core.Paper.coll, q, {'$unset': {'recommendations':''}},
+               multi=True)
 
 def add_delivery_post_id():
     'add postID to each Person.received record'
@@ -42,6 +45,28 @@ def add_post_citations(citationType2='discuss'):
             for c in p.add_citations(papers[1:], citationType2):
                 print '  added citation to %s' % c.parent.get_value('local_url')
 
+def move_deliveries():
+    'move old Person.received arrays into the Delivery inbox collection'
+    n = 0
+    for d in core.Person.find({'received':{'$exists':True}},
+                              {'received':1, 'topics':1, 'topicOptions':1,
+                               'subscriptions':1}):
+        updates = bulk.get_delivery_updates(d['_id'], d['received'],
+                                            core.get_delivery_levels(d))
+        bulk_update(core.Delivery.coll, updates, upsert=True)
+        update_doc(core.Person.coll, {'_id': d['_id']},
+                   {'$unset': {'received':''}})
+        n += len(updates)
+    return n
+
+def build_topic_feeds():
+    'copy existing posts into the TopicFeed (topic None if untagged)'
+    n = 0
+    for post in core.Post.find_obj():
+        core.add_to_topic_feeds(post)
+        n += 1
+    return n
+
 def unified_posts():
     print 'deleting old rec records...'
     delete_recs()
@@ -54,20 +79,21 @@ def unified_posts():
 # utilities for cleaning up / merging Paper records
 
 def delete_papers(query={'arxiv.id': {'$regex':'error'}},
-                  paperColl=core.Paper.coll, personColl=core.Person.coll):
-    '''delete papers matching query from both paper collection
-    and Person reading lists'''
+                  paperColl=core.Paper.coll, personColl=core.Person.coll,
+                  deliveryColl=core.Delivery.coll,
+                  feedColl=core.TopicFeed.coll):
+    '''delete papers matching query from paper collection,
+    Person reading lists, inboxes and topic feeds'''
     n = 0
     for d in paperColl.find(query, {'_id':1}):
         paperID = d['_id']
-        personColl.update({'readingList': paperID}, 
-                          {'$pull': {'readingList': paperID}}, 
-                          multi=True) # delete from readingLists
-        personColl.update({'received.paper': paperID}, 
-                          {'$pull': {'received': {'paper': paperID}}}, 
-                          multi=True) # update readingLists
+        update_doc(personColl, {'readingList': paperID},
+                   {'$pull': {'readingList': paperID}},
+                   multi=True) # delete from readingLists
+        remove_docs(deliveryColl, {'paper': paperID}) # delete from inboxes
+        remove_docs(feedColl, {'paper': paperID}) # delete from topic feeds
         n += 1
-    paperColl.remove(query) # delete papers
+    remove_docs(paperColl, query) # delete papers
     print 'deleted %d papers.' % n
 
 def check_papers_unique():
@@ -127,14 +153,21 @@ def update_paper_array(p, attr, pleaseUpdate, docs, pid):
         p.update({attr: data})
         print 'unified %d %s on paper %s' % (len(docs), attr, pid)
 
-def replace_paper(p, newID, savecoll=None, personColl=core.Person.coll):
+def replace_paper(p, newID, savecoll=None, personColl=core.Person.coll,
+                  deliveryColl=core.Delivery.coll,
+                  feedColl=core.TopicFeed.coll):
     '''delete paper and update reading lists to repliace ir with newID'''
-    personColl.update({'readingList': p._id}, 
-                      {'$set': {'readingList.$': newID}}, 
-                      multi=True) # update readingLists
-    personColl.update({'received.paper': p._id}, 
-                      {'$set': {'received.$.paper': newID}}, 
-                      multi=True) # update readingLists
+    update_doc(personColl, {'readingList': p._id},
+               {'$set': {'readingList.$': newID}},
+               multi=True) # update readingLists
+    update_doc(deliveryColl, {'paper': p._id}, {'$set': {'paper': newID}},
+               multi=True) # update inboxes
+    newPaper = core.Paper(newID)
+    update_doc(feedColl, {'paper': p._id},
+               {'$set': {'paper': newID,
+                         'paperTitle': getattr(newPaper, 'title', ''),
+                         'paperURL': newPaper.get_value('local_url')}},
+               multi=True) # update topic feeds
     if savecoll: # backup to another collection
         savecoll.insert(p._dbDocDict)
     p.delete() # delete from papers collection
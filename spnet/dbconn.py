@@ -1,14 +1,40 @@
 import pymongo
 
+_clients = {} # one shared MongoClient (and its pool) per settings
+
+def get_client(**kwargs):
+    'get the shared MongoClient for these connection settings'
+    key = repr(sorted(kwargs.items()))
+    try:
+        return _clients[key]
+    except KeyError:
+        client = _clients[key] = pymongo.MongoClient(**kwargs)
+        return client
+
 
 class DBConnection(object):
     'store different collection objects on specified classes'
     def __init__(self, classDict, user=None, password=None, dbname='spnet',
+                 ensureIndexes=True, maxPoolSize=100, waitQueueTimeoutMS=5000,
+                 socketTimeoutMS=30000, connectTimeoutMS=10000,
+                 serverSelectionTimeoutMS=10000, w=1, readPreferences=None,
                  **kwargs):
         '''Each keyword argument specifies an attr:collection pair.
         If collection is a string, it must be of the form dbname.collname.
-        Otherwise it must be a collection object to be saved as-is.'''
-        self._conn = pymongo.connection.Connection(**kwargs)
+        Otherwise it must be a collection object to be saved as-is.
+        If ensureIndexes, create any indexes the classes declare.
+        The pool size, timeouts and write concern w bound how long
+        a request thread can wait on the db; other kwargs (e.g. host,
+        port) are passed to MongoClient.  readPreferences optionally
+        maps class names to the readPreference for their queries,
+        e.g. {"Paper": "secondaryPreferred"}.'''
+        kwargs.update(maxPoolSize=maxPoolSize, w=w,
+                      waitQueueTimeoutMS=waitQueueTimeoutMS,
+                      socketTimeoutMS=socketTimeoutMS,
+                      connectTimeoutMS=connectTimeoutMS)
+        if pymongo.version_tuple[0] >= 3: # not supported by pymongo 2
+            kwargs['serverSelectionTimeoutMS'] = serverSelectionTimeoutMS
+        self._conn = get_client(**kwargs)
         if dbname: # authenticating to access DB
             accessDB = self._conn[dbname]
             accessDB.authenticate(user, password)
@@ -18,3 +44,20 @@ class DBConnection(object):
                 klass.coll = self._conn[db][coll]
             else:
                 klass.coll = v
+        if readPreferences:
+            for klass in classDict:
+                try:
+                    klass.readPreference = readPreferences[klass.__name__]
+                except KeyError:
+                    pass
+        if ensureIndexes:
+            self.ensure_indexes(classDict)
+
+    def ensure_indexes(self, classes):
+        'create indexes declared by each class, if not already present'
+        for klass in classes:
+            try:
+                klass.ensure_indexes()
+            except pymongo.errors.OperationFailure, e: # e.g. duplicate keys
+                print 'WARNING: %s index creation failed: %s' \
+                      % (klass.__name__, e)
@@ -0,0 +1,58 @@
+import connect
+from base import get_index_spec, aggregate_iter
+from pymongo.errors import OperationFailure
+
+
+def get_declared_indexes(classes):
+    '''get dict of {collection full name: (coll, {keys:[class names]})}
+    for the indexes declared by each class'''
+    declared = {}
+    for klass in classes:
+        coll = klass.coll
+        indexes = declared.setdefault(coll.full_name, (coll, {}))[1]
+        for spec in klass._indexes:
+            keys = tuple(get_index_spec(spec)[0])
+            indexes.setdefault(keys, []).append(klass.__name__)
+    return declared
+
+def get_index_usage(coll):
+    '''get dict of {index name: number of uses since server start},
+    or None if the server does not support $indexStats (mongodb < 3.2)'''
+    try:
+        return dict([(d['name'], d['accesses']['ops'])
+                     for d in aggregate_iter(coll, [{'$indexStats': {}}])])
+    except OperationFailure:
+        return None
+
+def report_indexes(classes=connect.connectDict):
+    '''print indexes declared by classes but missing from the db,
+    and db indexes that are undeclared or unused.
+    Returns lists of (collection, keys) for missing, unused indexes.'''
+    missing = []
+    unused = []
+    for collName, (coll, indexes) in get_declared_indexes(classes).items():
+        info = coll.index_information()
+        present = dict([(tuple(d['key']), name) for name, d in info.items()])
+        for keys, classNames in indexes.items():
+            if keys not in present:
+                missing.append((collName, keys))
+                print 'MISSING %s %s (for %s)' % (collName, keys,
+                                                  ', '.join(classNames))
+        usage = get_index_usage(coll)
+        for keys, name in present.items():
+            if name == '_id_':
+                continue
+            elif keys not in indexes:
+                unused.append((collName, keys))
+                print 'UNDECLARED %s %s' % (collName, name)
+            elif usage is not None and not usage.get(name):
+                unused.append((collName, keys))
+                print 'UNUSED %s %s' % (collName, name)
+    return missing, unused
+
+
+if __name__ == '__main__':
+    dbconn = connect.init_connection(ensureIndexes=False)
+    missing, unused = report_indexes()
+    print '%d missing, %d undeclared or unused indexes' \
+          % (len(missing), len(unused))
@@ -3,6 +3,7 @@ import core
 import errors
 from datetime import datetime
 import bulk
+from base import WriteSession
 
 #################################################################
 # hashtag processors
@@ -210,77 +211,74 @@ def find_or_insert_posts(posts, get_post_comments, find_or_insert_person,
                 continue # matches DB record, so nothing to do
         except KeyError:
             pass
-        if spnetworkOnly and content.find('#spnetwork') < 0:
-            if post:
-                post.delete() # remove old Post: no longer tagged!
-            continue # ignore posts lacking our spnetwork hashtag
-        # extract tags and IDs:
-        citations, topics, primary = get_citations_types_and_topics(content)
-        try:
-            primary_paper_ID = citations[primary]
-            paper = get_paper(primary,primary_paper_ID[1])
-        except KeyError:
-            continue # no link to a paper, so nothing to save.
-        if post and post.parent != paper: # changed primary binding!
-            post.delete() # delete old binding
-            post = None # must resave to new binding
-        d['text'] =  content
-        if process_post:
-            process_post(d)
-        d['sigs'] = get_topicIDs(topics, get_id(d),timeStamp, source)
-        d['citationType'] = citations[primary][0]
-        oldCitations = {}
-        if post is None: # save to DB
-            userID = get_user(d)
-            author = find_or_insert_person(userID)
-            d['author'] = author._id
-            post = core.Post(docData=d, parent=paper)
+        with WriteSession(): # merge this post's writes into bulk writes
+            if spnetworkOnly and content.find('#spnetwork') < 0:
+                if post:
+                    post.delete() # remove old Post: no longer tagged!
+                continue # ignore posts lacking our spnetwork hashtag
+            # extract tags and IDs:
+            citations, topics, primary = get_citations_types_and_topics(content)
             try:
-                topicsDict
-            except NameError:
-                topicsDict, subsDict = bulk.get_people_subs()
-            bulk.deliver_rec(paper._id, d, topicsDict, subsDict)
-            if recentEvents is not None: # add to monitor deque
-                saveEvents.append(post)
-        else: # update DB with new data and etag
-            post.update(d)
-            for c in getattr(post, 'citations', ()): # index old citations
-                oldCitations[c.parent] = c
-        for ref, meta in citations.iteritems(): # add / update new citations
-            if ref != primary:
-                paper2 = get_paper(ref, meta[1])
-                try: # if already present, just update citationType if changed
-                    c = oldCitations[paper2]
-                    if c.citationType != meta[0]:
-                        c.update(dict(citationType=meta[0]))
-                    del oldCitations[paper2] # don't treat as old citation
-                except KeyError:
-                    post.add_citations([paper2], meta[0])
-        for c in oldCitations.values():
-            c.delete() # delete citations no longer present in updated post
-        yield post
-        if get_replycount(d) > 0:
-            for c in get_post_comments(get_id(d)):
-                if process_reply:
-                    process_reply(c)
-                try:
-                    r = core.Reply(get_id(c))
-                    if getattr(r, 'etag', None) != c.get('etag', ''):
-                        # update DB record with latest data
-                        r.update(dict(etag=c.get('etag', ''),
-                                      text=get_content(c),
-                                      updated=c.get('updated', '')))
-                    continue # already stored in DB, no need to save
-                except KeyError:
-                    pass
-                userID = get_user(c)
+                primary_paper_ID = citations[primary]
+                paper = get_paper(primary,primary_paper_ID[1])
+            except KeyError:
+                continue # no link to a paper, so nothing to save.
+            if post and post.parent != paper: # changed primary binding!
+                post.delete() # delete old binding
+                post = None # must resave to new binding
+            d['text'] =  content
+            if process_post:
+                process_post(d)
+            d['sigs'] = get_topicIDs(topics, get_id(d),timeStamp, source)
+            d['citationType'] = citations[primary][0]
+            oldCitations = {}
+            if post is None: # save to DB
+                userID = get_user(d)
                 author = find_or_insert_person(userID)
-                c['author'] = author._id
-                c['text'] =  get_content(c)
-                c['replyTo'] = get_id(d)
-                r = core.Reply(docData=c, parent=post._parent_link)
+                d['author'] = author._id
+                post = core.Post(docData=d, parent=paper)
+                bulk.queue_delivery(paper._id, d) # to deliveryQueue, if any
                 if recentEvents is not None: # add to monitor deque
-                    saveEvents.append(r)
+                    saveEvents.append(post)
+            else: # update DB with new data and etag
+                post.update(d)
+                for c in getattr(post, 'citations', ()): # index old citations
+                    oldCitations[c.parent] = c
+            for ref, meta in citations.iteritems(): # add / update new citations
+                if ref != primary:
+                    paper2 = get_paper(ref, meta[1])
+                    try: # if already present, just update citationType if changed
+                        c = oldCitations[paper2]
+                        if c.citationType != meta[0]:
+                            c.update(dict(citationType=meta[0]))
+                        del oldCitations[paper2] # don't treat as old citation
+                    except KeyError:
+                        post.add_citations([paper2], meta[0])
+            for c in oldCitations.values():
+                c.delete() # delete citations no longer present in updated post
+            if get_replycount(d) > 0:
+                for c in get_post_comments(get_id(d)):
+                    if process_reply:
+                        process_reply(c)
+                    try:
+                        r = core.Reply(get_id(c))
+                        if getattr(r, 'etag', None) != c.get('etag', ''):
+                            # update DB record with latest data
+                            r.update(dict(etag=c.get('etag', ''),
+                                          text=get_content(c),
+                                          updated=c.get('updated', '')))
+                        continue # already stored in DB, no need to save
+                    except KeyError:
+                        pass
+                    userID = get_user(c)
+                    author = find_or_insert_person(userID)
+                    c['author'] = author._id
+                    c['text'] =  get_content(c)
+                    c['replyTo'] = get_id(d)
+                    r = core.Reply(docData=c, parent=post._parent_link)
+                    if recentEvents is not None: # add to monitor deque
+                        saveEvents.append(r)
+        yield post # no session open while the caller runs
 
     if saveEvents and recentEvents is not None:
         saveEvents.sort(lambda x,y:cmp(x.published, y.published))
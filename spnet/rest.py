@@ -1,7 +1,7 @@
 import cherrypy
 import glob
 import os.path
-from base import IdString
+from base import IdString, IdentityMap, DBStats
 import view
 
 def request_tuple():
@@ -39,6 +39,10 @@ class Collection(object):
     return HTML representation of the doc object.
     This will typically be a renderer of a Jinja2 template.
     '''
+    dbStatsHeader = False # report db calls in an X-DB-Stats response header
+    dbStatsLog = False # report db calls for each request in the cherrypy log
+    dbStatsBytes = False # also count bytes of decoded docs (re-encodes them)
+    readOnlyGET = False # GET loads doc as raw BSON, decoding only what's used
     def __init__(self, name, klass, templateEnv=None, templateDir='_templates',
                  docArgs=None, collectionArgs=None, **templateArgs):
         self.name = name
@@ -52,6 +56,30 @@ class Collection(object):
 
     def default(self, docID=None, *args, **kwargs):
         'process all requests for this collection'
+        if not (self.dbStatsHeader or self.dbStatsLog): # no stats overhead
+            with IdentityMap(): # load each document at most once per request
+                return self._dispatch(docID, *args, **kwargs)
+        route = '%s /%s' % (cherrypy.request.method, self.name)
+        if docID:
+            route += '/{id}'
+            if args:
+                route += '/' + args[0]
+        with DBStats(route, self.dbStatsBytes) as stats:
+            with IdentityMap(): # load each document at most once per request
+                response = self._dispatch(docID, *args, **kwargs)
+            self.report_db_stats(stats)
+        return response
+    default.exposed = True
+
+    def report_db_stats(self, stats):
+        'write db call counts for this request to header and / or log'
+        if self.dbStatsHeader:
+            cherrypy.response.headers['X-DB-Stats'] = stats.summary()
+        if self.dbStatsLog:
+            cherrypy.log('%s %s' % (stats.route, stats.summary()), 'DBSTATS')
+
+    def _dispatch(self, docID=None, *args, **kwargs):
+        'route request to the right method, document or subcollection'
         try:
             method, mimeType = request_tuple()
             if docID: # a specific document from this collection
@@ -88,7 +116,6 @@ class Collection(object):
                                          % method, 405)
         except Exception:
             return view.report_error('REST collection error', 500)
-    default.exposed = True
 
     def _request(self, method, mimeType, *args, **kwargs):
         'dispatch to proper handler method, or return appropriate error'
@@ -121,6 +148,8 @@ Please check whether you have the correct ID or spelling.""")
         'default GET method'
         kwargs.update(self.docArgs)
         if not parents: # works with documents with unique ID
+            if self.readOnlyGET and cherrypy.request.method == 'GET':
+                kwargs['readOnly'] = True # just for display
             return self.klass(docID, **kwargs)
         elif len(parents) == 1: # works with ArrayDocument
             return self.klass((parents.values()[0]._id, docID), **kwargs)
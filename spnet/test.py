@@ -1,4 +1,5 @@
 import core, connect
+import base
 import gplus
 ##import pubmed
 ##import pickle
@@ -19,6 +20,10 @@ def destroy_db_and_test():
     its own test data.'''
     dbconn = connect.init_connection()
     dbconn._conn.drop_database('spnet') # start test from a blank slate
+    dbconn.ensure_indexes(connect.connectDict)
+    assert 'posts.id_1' in core.Post.coll.index_information()
+    assert core.Paper.get_read_coll() is core.Paper.coll # primary
+    assert core.Paper.get_read_coll('secondaryPreferred').name == 'paper'
     rootColl = apptree.get_collections()
 
     lorem = '''Lorem ipsum dolor sit amet, consectetur adipisicing elit, sed do eiusmod tempor incididunt ut labore et dolore magna aliqua. Ut enim ad minim veniam, quis nostrud exercitation ullamco laboris nisi ut aliquip ex ea commodo consequat. Duis aute irure dolor in reprehenderit in voluptate velit esse cillum dolore eu fugiat nulla pariatur. Excepteur sint occaecat cupidatat non proident, sunt in culpa qui officia deserunt mollit anim id est laborum.'''
@@ -56,6 +61,9 @@ def destroy_db_and_test():
     topicWords = incoming.get_topicIDs(['cosmology', 'astrophysics'],
                                        1, datetime.utcnow(), 'test')
     assert topicWords == ['cosmology', 'astrophysics']
+    assert list(core.SIG.find({'_id': {'$ne': 'cosmology'}},
+                              sortKeys={'_id': 1}, limit=2)) \
+                              == ['astrophysics', 'lambdaCDMmodel']
     astroSIG = core.SIG('astrophysics')
     assert astroSIG.name == '#astrophysics'
     assert astroSIG.origin == dict(source='test', id=1)
@@ -69,9 +77,18 @@ def destroy_db_and_test():
     assert core.Person(jojo._id).topics == [sig1._id]
     assert core.SIG(sig1._id).interests == [int1]
     assert core.SIG(sig1._id).get_interests() == {paper1:[jojo]}
+    d = core.SIG(sig1._id).get_interests(limit=1)
+    assert d.keys() == [paper1] and d[paper1][0].name == jojo.name
+    assert d.keys()[0].interests == [int1] # partial doc loads the rest
+    assert d[paper1][0].topics == [sig1._id]
 
     intAgain = core.PaperInterest((paper1._id, jojo._id))
     assert intAgain == int1
+    intAgain.add_topic(sig2._id)
+    intAgain.add_topic(sig2._id) # no duplicates
+    assert core.PaperInterest((paper1._id, jojo._id)).topics == [sig1, sig2]
+    assert intAgain.remove_topic(sig2._id) is intAgain
+    assert core.PaperInterest((paper1._id, jojo._id)).topics == [sig1]
     try:
         intAgain.remove_topic(sig2._id)
     except KeyError:
@@ -146,6 +163,8 @@ def destroy_db_and_test():
 
     assert core.Person(jojo._id).email == [a1]
     assert core.Person(jojo._id).replies == [reply1]
+    r = core.Person(jojo._id).replies[0] # links batch-loaded with query
+    assert 'parent' in r.__dict__ and 'replyTo' in r.__dict__
     jgp = core.GplusPersonData(1234)
     assert jgp.parent == jojo
     assert jgp.etag == 'oldversion'
@@ -167,19 +186,100 @@ def destroy_db_and_test():
     assert len(posts1) == 1
     assert posts1 == [post1]
     assert posts1[0].text == 'interesting paper!'
+    assert 'text' not in posts1[0].__dict__ # read from _dbDocDict
     assert list(posts1[0].get_replies()) == [reply1]
     assert core.Post(98765).author == fred
+    author = core.Post(98765).author # loaded with 'card' profile
+    assert 'age' not in author._dbDocDict and author.name == 'fred'
+    assert author.age == 56 # transparently reloads the full Person
+    assert 'age' in author._dbDocDict
     assert core.Reply(7890).replyTo == post1
     assert core.Reply(7890).parent == paper1
     assert filter(lambda x:not x.is_rec(), core.Person(fred._id).posts) == [post1]
     assert filter(lambda x:not x.is_rec(), core.SIG(sig1._id).posts) == [post1]
     assert core.Post(98765).sigs == [sig1]
+    posts = list(core.Post.find_obj({'posts.sigs':sig1._id},
+                                    prefetch=('author', 'parent', 'sigs')))
+    for post in posts: # links already loaded by batch queries
+        assert 'author' in post.__dict__ and 'parent' in post.__dict__
+    assert set([post.author for post in posts]) == set([fred, jojo])
+    assert set([post.parent for post in posts]) == set([paper1, paper2])
+    agg = list(core.Post.find({'posts.sigs':sig1._id}))
+    newest = [d['published'] for d in
+              core.Post.find({'posts.sigs':sig1._id}, idOnly=False,
+                             sortKeys=[('posts.published', -1)], limit=1)]
+    core.Post.useAggregate = False # compare with Python filtering
+    try:
+        assert set(agg) == set(core.Post.find({'posts.sigs':sig1._id}))
+        assert [d['published'] for d in
+                core.Post.find({'posts.sigs':sig1._id}, idOnly=False,
+                               sortKeys=[('posts.published', -1)],
+                               limit=1)] == newest # sorted, limited here
+        assert len(list(core.Post.find({'posts.sigs':sig1._id},
+                                       skip=1))) == len(agg) - 1
+    finally:
+        core.Post.useAggregate = True
+    assert len(list(core.Post.find({'posts.sigs':sig1._id}, limit=1))) == 1
+    page1 = core.Post.find_page({'posts.sigs':sig1._id}, 1)
+    page2 = core.Post.find_page({'posts.sigs':sig1._id}, 1, page1.nextToken)
+    assert len(page1) == 1 and len(page2) == 1 and page1[0] != page2[0]
+    assert page1[0].published >= page2[0].published
+    bulkPapers = core.Paper.insert_many([dict(title='bulk paper %d' % i)
+                                         for i in range(3)],
+                                        returnObjects=True)
+    assert core.Paper(bulkPapers[2]._id).title == 'bulk paper 2'
+    core.Reply.append_many(bulkPapers[0], [dict(author=jojo._id, text='ok',
+                                                id=i, replyTo=98765)
+                                           for i in (11111, 11112)])
+    assert core.Reply(11112).parent == bulkPapers[0]
+    assert core.Reply(11112).published is not None # timestamp added
+    core.Post.append_many(bulkPapers[1], [dict(author=jojo._id, id=11113,
+                                               text='bulk', sigs=[sig1._id])])
+    assert [r['post'] for r in core.TopicFeed.find({'topic': sig1._id},
+                                                    idOnly=False)
+            if r['post'] == 11113] == [11113] # via Post.insert() hooks
+    core.TopicFeed.coll.remove({'post': 11113})
+    core.Paper.coll.remove({'_id':{'$in':[p._id for p in bulkPapers]}})
+    with base.WriteSession() as session: # writes are merged and deferred
+        fred.update(dict(age=57))
+        fred.update(dict(name='fred'))
+        assert len(session.pending) == 1
+        assert core.Person.coll.find_one(fred._id)['age'] == 56
+        assert core.Person(fred._id).age == 57 # query sends pending writes
+    fred.update(dict(age=56))
+    with base.DBStats(countBytes=True) as stats:
+        core.Person(fred._id)
+        list(core.Post.find({'posts.author':fred._id}))
+    assert stats.ops['find_one'][:2] == [1, 1]
+    assert stats.totals()[0] >= 2 and stats.totals()[2] > 0
+    base.set_slow_query_log(0.) # log every call
+    slowLog = base.slowQueryLog
+    try:
+        core.Post(98765)
+    finally:
+        base.set_slow_query_log(None)
+    entry = slowLog.entries[-1]
+    assert entry['klass'] == 'Post' and entry['shape'] == {'posts.id': '?'}
 
     replyAgain = core.Reply(docData=dict(author=fred._id, text='interesting paper!',
                                      id=7890, replyTo=98765), parent=paper1,
                             insertNew='findOrInsert')
     assert replyAgain == reply1
     assert core.Paper(paper1._id).replies == [reply1]
+    p1 = core.Paper(paper1._id, readOnly=True) # display-only raw BSON
+    assert p1.replies == [reply1] and p1.title == paper1.title
+    try:
+        p1.update(dict(title='oops'))
+    except base.ReadOnlyError:
+        pass
+    else:
+        raise AssertionError('failed to refuse write to readOnly Paper')
+    try:
+        p1.replies[0].update(dict(text='oops'))
+    except base.ReadOnlyError:
+        pass
+    else:
+        raise AssertionError('failed to refuse write to readOnly Reply')
 
     reply2 = core.Reply(docData=dict(author=jojo._id, text='This paper really made me think.',
                                      id=7891, replyTo=98765), parent=paper1,
@@ -188,6 +288,29 @@ def destroy_db_and_test():
     assert core.Paper(paper1._id).replies == [reply1, reply2]
     assert core.Paper(str(paper1._id)) == paper1, 'auto ID conversion failed'
 
+    p1 = core.Paper(paper1._id)
+    assert 'posts' not in p1.__dict__ # not built until accessed
+    assert post1 in p1.posts and 'posts' in p1.__dict__
+    p1 = core.Paper(paper1._id, fields=core.Paper.noArrays)
+    assert 'posts' not in p1._dbDocDict and 'replies' not in p1._dbDocDict
+    assert p1.title == paper1.title
+    with base.DBStats() as stats: # optional fields not in the projection
+        assert p1.get_value('local_url') == paper1.get_value('local_url')
+        assert getattr(p1, 'doi', None) is None
+    assert 'find_one' not in stats.ops # so no reload of the full doc
+    assert post1 in p1.posts # excluded field reloads it
+
+    with base.IdentityMap(): # each doc loaded at most once per request
+        cached = core.Paper(paper1._id)
+        assert core.Paper.fetch(str(paper1._id)) is cached
+        assert core.Post(98765).parent is cached
+        cached.update(dict(texDollars=1)) # update must drop the cached copy
+        assert core.Paper.fetch(paper1._id) is not cached
+        assert core.Paper(paper1._id).texDollars == 1
+        fresh = core.Paper(paper1._id)
+        fresh._dbDocDict['authorNames'].append('nobody') # in-place change
+        assert 'nobody' not in core.Paper(paper1._id)._dbDocDict['authorNames']
+
     assert p.issues[0] == issue1
     assert len(p.issues[0].votes) == 1
     assert len(rec2.sigs) == 2
@@ -235,12 +358,20 @@ def destroy_db_and_test():
     fred.array_del('numbers', 17)
     assert core.Person(fred._id).numbers == [6]
 
+    fred.array_append('readingList', paper2)
+    fred.array_append('readingList', ObjectId()) # dangling ID is skipped
+    fred.array_append('readingList', paper1)
+    assert core.Person(fred._id).readingList == [paper2, paper1]
+
     a4.array_append('numbers', 17)
     assert core.EmailAddress(a4.address).numbers == [17]
     a4.array_append('numbers', 6)
     assert core.EmailAddress(a4.address).numbers == [17, 6]
     a4.array_del('numbers', 17)
     assert core.EmailAddress(a4.address).numbers == [6]
+    core.EmailAddress(a4.address).array_append('numbers', 8)
+    a4.array_del('numbers', 8) # our copy is stale, but db still has it
+    assert core.EmailAddress(a4.address).numbers == [6]
 
     rec3 = core.Post(docData=dict(author=fred._id, citationType='recommend',
                                   text='I think this is a major breakthrough.',
@@ -249,6 +380,19 @@ def destroy_db_and_test():
 
     assert core.SIG(sig1._id).recommendations == [rec2]
     assert len(core.SIG(sig2._id).recommendations) == 3
+    assert [r.post for r in core.SIG(sig1._id).get_feed_page(True)] \
+           == [rec2.id]
+    sig2Page = core.SIG(sig2._id).get_feed_page(True, 2)
+    assert len(sig2Page) == 2 and sig2Page[0].post == rec3.id # newest first
+    assert len(core.SIG(sig2._id).get_feed_page(True, 2,
+                                                sig2Page.nextToken)) == 1
+    rec3.update(dict(sigs=[sig1._id])) # retag moves its feed entry
+    assert rec3.id not in [r.post for r in
+                           core.SIG(sig2._id).get_feed_page(True)]
+    assert rec3.id in [r.post for r in core.SIG(sig1._id).get_feed_page(True)]
+    rec3.update(dict(sigs=[sig2._id]))
+    assert [r.post for r in core.SIG(sig1._id).get_feed_page(True)] \
+           == [rec2.id]
 
     it = gplus.publicAccess.get_person_posts('107295654786633294692')
     testPosts = list(gplus.publicAccess.find_or_insert_posts(it))
@@ -295,6 +439,17 @@ def destroy_db_and_test():
 
     assert recReply.replyTo == rec3
     assert list(recReply.replyTo.get_replies()) == [recReply]
+    feedRec = [r for r in core.SIG(sig2._id).get_feed_page(True)
+               if r.post == rec3.id][0] # reply copied to topic feed
+    assert feedRec.get_reply_count() == 1
+    assert [r['id'] for r in feedRec.get_replies()] == [recReply.id]
+    moreReplies = [core.Reply(docData=dict(author=fred._id, id=78902 + i,
+                                           replyTo=3456, text='thanks!'),
+                              parent=paper2._id) for i in range(3)]
+    moreReplies[0].delete() # backfills the feed copy from the paper
+    feedRec = [r for r in core.SIG(sig2._id).get_feed_page(True)
+               if r.post == rec3.id][0]
+    assert feedRec.get_reply_count() == 3 and len(feedRec.get_replies()) == 3
 
     # pubmed eutils network server constantly failing now??
     ## pubmedDict = pubmed.get_pubmed_dict('23482246')
@@ -336,7 +491,79 @@ def destroy_db_and_test():
     assert incoming.get_paper(primary,refs[primary][1]) == spnetPaper
 
     topics, subs = bulk.get_people_subs()
+    subsIndex = bulk.SubscriptionIndex()
+    subsIndex.rebuild()
+    for author, people in subs.items():
+        assert subsIndex.get_recipients(author, ()) == set(people) - set([author])
+    assert subsIndex.check() == [] # consistent with the DB
     bulk.deliver_recs(topics, subs)
     assert len(core.Person(jojo._id).received) == 4
     assert len(core.Person(fred._id).received) == 2
-
+    delivered, skipped = bulk.deliver_recs(topics, subs) # re-delivery
+    assert delivered == 0 and skipped >= 6 # just updates the same records
+    jobQueue = bulk.DeliveryQueue()
+    jobQueue.put(paper2._id, core.Post(rec2.id)._dbDocDict)
+    jobQueue.put(paper2._id, core.Post(rec2.id)._dbDocDict) # no duplicate
+    assert jobQueue.depth() == 1
+    assert jobQueue.run_pending() == 1
+    stats = jobQueue.get_stats()
+    assert stats['depth'] == 0 and stats['done'] == 1
+    assert stats['delivered'] == 0 and stats['skipped'] > 0 # already there
+    assert len(core.Person(jojo._id).received) == 4
+    fullQueue = bulk.DeliveryQueue(maxDepth=0) # full, so delivers inline
+    fullQueue.put(paper2._id, core.Post(rec2.id)._dbDocDict)
+    assert fullQueue.get_stats()['inline'] == 1
+    flakyQueue = bulk.DeliveryQueue(pollInterval=0.)
+    claims = []
+    def flaky_claim(): # one transient error, then stop the worker
+        claims.append(1)
+        if len(claims) == 1:
+            raise IOError('lost connection')
+        flakyQueue.running = False
+    flakyQueue.claim = flaky_claim
+    flakyQueue.running = True
+    flakyQueue.work() # survives the error
+    assert len(claims) == 2
+    recs = core.Person(jojo._id).get_deliveries()
+    assert recs == sorted(recs, key=lambda r:(r['priority'], r['published']),
+                          reverse=True)
+    core.TopicOptions(docData=dict(topic=sig1._id, fromMySubs='hide'),
+                      parent=jojo._id) # rescores jojo's deliveries
+    assert len(core.Person(jojo._id).get_deliveries()) < len(recs)
+    core.TopicOptions.find_obj_in_parent(core.Person(jojo._id),
+                                         sig1._id).delete() # rescores too
+    assert len(core.Person(jojo._id).get_deliveries()) == len(recs)
+    core.TopicOptions(docData=dict(topic=sig1._id, fromMySubs='hide'),
+                      parent=jojo._id)
+    sig2Posts = set([r['post'] for r in core.Person(jojo._id).get_deliveries()
+                     if sig2._id in r['topics']])
+    core.Delivery.coll.remove({'person':jojo._id, 'topics':sig2._id})
+    core.add_hot_feed('topic', sig2._id) # so jojo pulls sig2 posts instead
+    recs = core.Person(jojo._id).get_deliveries()
+    assert set([r['post'] for r in recs if sig2._id in r['topics']]) \
+           == sig2Posts
+    assert recs == sorted(recs, key=core.get_delivery_key)
+    core.HotFeed.coll.remove()
+    core._hotFeeds[0] = 0. # don't use cached hot feeds
+
+
+    doiPaper = core.Paper(docData=dict(title='A DOI paper', authorNames=[],
+                                       doi=dict(id='bxz9', DOI='10.1/xyz')))
+    doiTopic = core.SIG.find_or_insert('doitopic')
+    core.PaperInterest(docData=dict(author=fred._id, topics=[doiTopic._id]),
+                       parent=doiPaper)
+    with base.DBStats() as stats: # as rendered by get_topic.html
+        interests = doiTopic.get_interests()
+        assert [paper.get_value('local_url') for paper in interests] \
+               == ['/shortDOI/bxz9']
+    assert 'find_one' not in stats.ops # no reload of each paper
+
+    changed = [] # replacing subscriptions (as G+ sync does) is noticed
+    core.personChangeHooks.append(lambda personID, addTopics:
+                                  changed.append(personID))
+    try:
+        jojoSubs = core.Person(jojo._id)._dbDocDict.get('subscriptions', [])
+        core.Person(jojo._id).update(dict(subscriptions=jojoSubs))
+    finally:
+        core.personChangeHooks.pop()
+    assert changed == [jojo._id]
@@ -3,6 +3,7 @@ import connect
 import pickle
 import random
 from bson.objectid import ObjectId
+from base import bulk_update
 
 cache_filename = 'arxiv.pickle'
 
@@ -15,13 +16,14 @@ def drop_person_db():
 
 def load_papers(papers):
     'insert the set of paper dictionaries into the database'
-    n = 0
+    newPapers = {}
     for paper in papers:
         paper['_id'] = paperID = 'arxiv:' + paper['id'].split('/')[-1]
-        if not list(core.Paper.find(dict(_id=paperID), limit=1)):
-            p = core.Paper(docData=paper) # creates new record in DB
-            n += 1
-    return n
+        newPapers[paperID] = paper
+    for paperID in core.Paper.find(dict(_id={'$in': newPapers.keys()})):
+        del newPapers[paperID] # already in DB
+    core.Paper.insert_many(newPapers.values()) # creates new records in DB
+    return len(newPapers)
 
 def update_person_db():
     'use Paper database authors to construct Person db'
@@ -29,24 +31,27 @@ def update_person_db():
     for d in core.Person.find(fields=dict(name=1)):
         authors[d['name']] = d['_id']
     papersToUpdate = []
-    n = 0
+    newPeople = []
     for paper in core.Paper.find(fields=dict(authors=1), idOnly=False):
         if isinstance(paper['authors'][0], ObjectId):
             continue # already saved as Person records
-        paperID = paper['_id']
-        papersToUpdate.append(paperID)
+        papersToUpdate.append(paper)
         for a in paper['authors']:
             if a not in authors: # create new person record
-                p = core.Person(docData=dict(name=a))
-                authors[a] = p._id
-                n += 1
-    print 'Saved %d new author records...' % n
+                authors[a] = None
+                newPeople.append(dict(name=a))
+    print 'Saving %d new author records...' % len(newPeople)
+    core.Person.insert_many(newPeople) # sets _id on each dict
+    for d in newPeople:
+        authors[d['name']] = d['_id']
     print 'Updating %d paper records...' % len(papersToUpdate)
-    for paperID in papersToUpdate:
-        paper = core.Paper(paperID)
-        authorIDs = [authors[a] for a in paper._dbDocDict['authors']]
-        paper.update(dict(authors=authorIDs))
-    return n
+    updates = []
+    for paper in papersToUpdate:
+        authorIDs = [authors[a] for a in paper['authors']]
+        updates.append(({'_id': paper['_id']},
+                        {'$set': dict(authors=authorIDs)}))
+    bulk_update(core.Paper.coll, updates)
+    return len(newPeople)
 
 def add_random_recs():
     'for each person, add one rec to a randomly selected paper'
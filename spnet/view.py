@@ -5,6 +5,7 @@ from datetime import datetime, timedelta
 import collections
 from sessioninfo import get_session
 import webui
+from base import IdentityMap
 
 def redirect(path='/', body=None, delay=0):
     'redirect browser, if desired after showing a message'
@@ -118,13 +119,14 @@ class TemplateView(object):
         if user and user.force_reload():
             user = user.__class__(user._id) # reload from DB
             session['person'] = user # save on session
-        return f(kwargs=kwargs, hasattr=hasattr, enumerate=enumerate,
-                 urlencode=urllib.urlencode, list_people=people_link_list,
-                 getattr=getattr, str=str, map=map_helper, user=user,
-                 display_datetime=display_datetime, timesort=timesort,
-                 recentEvents=recentEventsDeque, len=len,
-                 messageOfTheDay=messageOfTheDay,
-                 Selection=webui.Selection, **kwargs) # apply template
+        with IdentityMap(): # load each document at most once per page
+            return f(kwargs=kwargs, hasattr=hasattr, enumerate=enumerate,
+                     urlencode=urllib.urlencode, list_people=people_link_list,
+                     getattr=getattr, str=str, map=map_helper, user=user,
+                     display_datetime=display_datetime, timesort=timesort,
+                     recentEvents=recentEventsDeque, len=len,
+                     messageOfTheDay=messageOfTheDay,
+                     Selection=webui.Selection, **kwargs) # apply template
 
 def get_view_options():
     'get dict of session kwargs passed to view templates'
@@ -1,6 +1,9 @@
 import cherrypy
 import thread
+import logging
 import core, connect
+import base
+import bulk
 import twitter
 import gplus
 import apptree
@@ -94,7 +97,11 @@ class Server(object):
             
 
 if __name__ == '__main__':
+    logging.basicConfig(filename='slowquery.log')
+    base.set_slow_query_log(0.1, sampleRate=0.1) # 10% of calls over 100 ms
     s = Server()
+    bulk.start_delivery_workers(4) # deliver new posts in the background
+    thread.start_new_thread(bulk.check_subscription_index, ()) # vs. gplus.py
     thread.start_new_thread(view.poll_recent_events, (s.papers.klass, s.topics.klass))
     print 'starting server...'
     s.start()